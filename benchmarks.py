@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Time the common EPub operations against generated books of different sizes.
+
+Results are printed and can be written to a JSON file with --output. Pass a file written by an
+earlier run to --compare to see how much each timing has changed, e.g. between two commits."""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+import epubmangler
+
+# Keyword arguments for `create_epub`
+SIZES = {
+    'small': {'chapters': 5, 'chapter_size': 5_000, 'subjects': 5, 'cover_size': 50_000},
+    'medium': {'chapters': 50, 'chapter_size': 20_000, 'subjects': 50, 'cover_size': 500_000},
+    'large': {'chapters': 500, 'chapter_size': 20_000, 'subjects': 500,
+              'cover_size': 5_000_000},
+    # A small OPF file in an archive of many files, like a comic or a dictionary
+    'members': {'chapters': 5, 'chapter_size': 5_000, 'subjects': 5, 'cover_size': 50_000,
+                'members': 5_000, 'member_size': 1_000},
+}
+VERSIONS = ('2.0', '3.0')
+
+
+def measure(function: Callable[[], Any], repeat: int,
+            setup: Callable[[], Any] = None) -> Dict[str, float]:
+    """Returns the minimum and median time taken by `function` in milliseconds. `setup` is run
+    before every call, but isn't timed."""
+
+    timings = []
+
+    for _run in range(repeat):
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {'min': round(min(timings), 4), 'median': round(statistics.median(timings), 4)}
+
+
+def run_book(path: Path, directory: Path, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Runs every benchmark against the book at `path`."""
+
+    results = {}
+    output = Path(directory, 'output.epub')
+    copy = Path(directory, 'copy.epub')
+
+    def remove_output():
+        if output.exists():
+            os.remove(output)
+
+    def modified_book(lazy: bool = False) -> epubmangler.EPub:
+        book = epubmangler.EPub(path, lazy=lazy)
+        book.set('title', 'Something else')
+        return book
+
+    results['is_epub'] = measure(lambda: epubmangler.is_epub(path), repeat)
+    results['read_metadata'] = measure(lambda: epubmangler.read_metadata(path), repeat)
+    results['open'] = measure(lambda: epubmangler.EPub(path), repeat)
+    results['open_lazy'] = measure(lambda: epubmangler.EPub(path, lazy=True), repeat)
+    results['open_mapped'] = measure(lambda: epubmangler.EPub(path, lazy=True, mapped=True),
+                                     repeat)
+
+    with epubmangler.EPub(path, lazy=True) as book:
+        results['get'] = measure(lambda: book.get('title'), repeat * 100)
+        results['get_all'] = measure(lambda: book.get_all('subject'), repeat * 100)
+        results['set'] = measure(lambda: book.set('title', 'Something else'), repeat * 100)
+        results['get_cover'] = measure(book.get_cover, repeat)
+
+    with epubmangler.EPub(path, lazy=True) as book:
+        results['get_cover_bytes'] = measure(book.get_cover_bytes, repeat)
+
+    with epubmangler.EPub(path, lazy=True, mapped=True) as book:
+        results['get_cover_bytes_mapped'] = measure(book.get_cover_bytes, repeat)
+
+    with modified_book() as book:
+        results['save'] = measure(lambda: book.save(output), repeat, remove_output)
+
+    with modified_book(lazy=True) as book:
+        results['save_lazy'] = measure(lambda: book.save(output), repeat, remove_output)
+        results['save_repack'] = measure(lambda: book.save(output, repack=True), repeat,
+                                         remove_output)
+
+    shutil.copy(path, copy)
+
+    with epubmangler.EPub(copy, lazy=True) as book:
+        def save_in_place():
+            book.set('title', 'Something else')
+            book.save(copy, overwrite=True)
+
+        results['save_in_place'] = measure(save_in_place, repeat)
+
+    remove_output()
+    os.remove(copy)
+    return results
+
+
+def run(sizes: Dict[str, Dict[str, int]], repeat: int) -> Dict[str, Any]:
+    """Creates a book of each size and version and benchmarks it."""
+
+    results = {'python': sys.version, 'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': repeat, 'books': {}}
+
+    with tempfile.TemporaryDirectory(prefix='epubmangler-') as directory:
+        for size, options in sizes.items():
+            for version in VERSIONS:
+                name = f'{size}-{version}'
+                path = Path(directory, f'{name}.epub')
+                epubmangler.create_epub(path, version, **options)
+
+                results['books'][name] = {'file_size': path.stat().st_size,
+                                          'timings': run_book(path, directory, repeat)}
+                print_book(name, results['books'][name])
+
+    return results
+
+
+def print_book(name: str, book: Dict[str, Any], previous: Dict[str, Any] = None) -> None:
+    """Prints the timings of one book, and the change since `previous` if it's given."""
+
+    print(f"\n{name} ({book['file_size']:,} bytes)")
+
+    for benchmark, timing in book['timings'].items():
+        line = f"  {benchmark:<24}{timing['median']:>12.4f} ms"
+
+        if previous and benchmark in previous['timings']:
+            before = previous['timings'][benchmark]['median']
+
+            if before:
+                line += f"{(timing['median'] - before) / before:>+10.1%}"
+
+        print(line)
+
+
+def compare(results: Dict[str, Any], previous: Dict[str, Any]) -> None:
+    """Prints every timing in `results` next to its change since `previous`."""
+
+    print(f"\nCompared to {previous['time']}:")
+
+    for name, book in results['books'].items():
+        print_book(name, book, previous['books'].get(name))
+
+
+if __name__ == '__main__':
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+    PARSER.add_argument('-o', '--output', help='write the results to this JSON file')
+    PARSER.add_argument('-c', '--compare', help='compare the results to an earlier JSON file')
+    PARSER.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of times to run each benchmark (default: 5)')
+    PARSER.add_argument('-s', '--size', action='append', choices=SIZES,
+                        help='only run this size of book (can be used more than once)')
+    ARGS = PARSER.parse_args()
+
+    RESULTS = run({size: SIZES[size] for size in ARGS.size or SIZES}, ARGS.repeat)
+
+    if ARGS.compare:
+        with open(ARGS.compare, encoding='utf-8') as previous_file:
+            compare(RESULTS, json.load(previous_file))
+
+    if ARGS.output:
+        with open(ARGS.output, 'w', encoding='utf-8') as output_file:
+            json.dump(RESULTS, output_file, indent=2)
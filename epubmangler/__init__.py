@@ -1,7 +1,13 @@
 """Tools to modify the metadata of .epub format ebooks."""
 
+from .aio import *
+from .archive import *
+from .cache import *
+from .create import *
 from .epub import *
 from .functions import *
 from .globals import *
+from .hooks import *
+from .library import *
 
 __version__ = VERSION
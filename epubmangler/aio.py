@@ -0,0 +1,162 @@
+"""An asyncio interface to EPub, for use in servers and other asynchronous programs."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import weakref
+
+from concurrent.futures import Executor
+from functools import partial
+from types import TracebackType
+from typing import Any, AsyncIterator, Callable, Dict, List, Self, Type
+
+from .archive import COPY_BUFFER_SIZE
+from .epub import EPub
+from .functions import read_metadata
+
+
+class RunnerFull(Exception):
+    """Raised by `AsyncRunner.run` when as many functions as the runner allows are already
+    waiting their turn."""
+
+
+class AsyncRunner:
+    """Runs blocking functions in `executor`, or the event loop's default executor if it is
+    None, without blocking the event loop. At most `concurrency` functions run at once, which
+    defaults to the number of CPUs. Anything else waits its turn without holding a thread, so
+    one huge book can't use every thread in the executor.
+
+    If `max_waiting` is given, at most that many functions wait their turn, and `run` raises
+    `RunnerFull` rather than queueing any more. Servers can use this to turn requests away while
+    they are busy, instead of letting the queue, and how long everything takes, grow."""
+
+    def __init__(self, executor: Executor = None, concurrency: int = None,
+                 max_waiting: int = None) -> Self:
+
+        self.executor: Executor = executor
+        self.concurrency: int = concurrency or os.cpu_count() or 1
+        self.max_waiting: int | None = max_waiting
+
+        # Semaphores belong to an event loop, so there is one for each loop the runner is used in
+        self._semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._waiting: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    async def run(self, function: Callable, *args: Any, **kwargs: Any) -> Any:
+        """Returns the result of `function(*args, **kwargs)`, called in the executor."""
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.setdefault(loop, asyncio.Semaphore(self.concurrency))
+        waiting = self._waiting.get(loop, 0)
+
+        if self.max_waiting is not None and semaphore.locked() and waiting >= self.max_waiting:
+            raise RunnerFull(f"{waiting} functions are already waiting to run")
+
+        self._waiting[loop] = waiting + 1
+
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[loop] -= 1
+
+        try:
+            return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+        finally:
+            semaphore.release()
+
+    def waiting(self) -> int:
+        """Returns how many functions are waiting their turn in the running event loop."""
+
+        return self._waiting.get(asyncio.get_running_loop(), 0)
+
+
+# Used when an AsyncEPub isn't given a runner of its own
+DEFAULT_RUNNER = AsyncRunner()
+
+
+class AsyncEPub:
+    """Wraps an `EPub` so that everything that reads or writes the archive is awaitable and runs
+    in an `AsyncRunner`. Use `AsyncEPub.open` to open a book.
+
+    Methods that only use the metadata in memory, such as `get`, `set` and `batch`, are fast,
+    so they are passed straight to the `EPub` and are not awaitable. Like `EPub`, an AsyncEPub
+    should only be used by one task at a time."""
+
+    def __init__(self, book: EPub, runner: AsyncRunner = None) -> Self:
+
+        self.book: EPub = book
+        self.runner: AsyncRunner = runner or DEFAULT_RUNNER
+
+    def __getattr__(self, name: str) -> Any:
+
+        return getattr(self.book, name)
+
+    # Special methods are looked up on the class, so __getattr__ doesn't pass these on
+
+    def __getitem__(self, name: str) -> Any:
+
+        return self.book[name]
+
+    def __setitem__(self, name: str, text: str) -> None:
+
+        self.book[name] = text
+
+    async def __aenter__(self) -> Self:
+
+        return self
+
+    async def __aexit__(self, _type: Type[BaseException] | None, _value: BaseException | None,
+                        _traceback: TracebackType | None) -> bool:
+
+        await self.close()
+        return False  # Raise any thrown exception before exiting
+
+    @classmethod
+    async def open(cls, path: str | bytes | os.PathLike, lazy: bool = False,
+                   mapped: bool = False, runner: AsyncRunner = None) -> Self:
+        """Opens the epub file at `path`. See `EPub` for the other arguments."""
+
+        runner = runner or DEFAULT_RUNNER
+
+        return cls(await runner.run(EPub, path, lazy=lazy, mapped=mapped), runner)
+
+    @staticmethod
+    async def read_metadata(path: str | bytes | os.PathLike,
+                            runner: AsyncRunner = None) -> List[Dict[str, Any]]:
+        """Returns the metadata of the epub file at `path` without opening it as an `EPub`.
+        See `read_metadata`."""
+
+        return await (runner or DEFAULT_RUNNER).run(read_metadata, path)
+
+    async def close(self) -> None:
+        """Removes the book's temporary files."""
+
+        await self.runner.run(self.book.__exit__, None, None, None)
+
+    async def get_cover_bytes(self) -> memoryview:
+        """See `EPub.get_cover_bytes`."""
+
+        return await self.runner.run(self.book.get_cover_bytes)
+
+    async def save(self, path: Any, **kwargs: Any) -> None:
+        """See `EPub.save`."""
+
+        await self.runner.run(self.book.save, path, **kwargs)
+
+    async def iter_bytes(self, chunk_size: int = COPY_BUFFER_SIZE,
+                         **kwargs: Any) -> AsyncIterator[bytes]:
+        """Yields the book as a new epub file in chunks. Each chunk is written in the runner, so
+        the archive can be streamed to a client without blocking. See `EPub.iter_bytes`."""
+
+        chunks = self.book.iter_bytes(chunk_size, **kwargs)
+
+        try:
+            while (chunk := await self.runner.run(next, chunks, None)) is not None:
+                yield chunk
+        finally:
+            chunks.close()
+
+    async def to_bytes(self, **kwargs: Any) -> bytes:
+        """See `EPub.to_bytes`."""
+
+        return await self.runner.run(self.book.to_bytes, **kwargs)
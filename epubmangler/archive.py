@@ -0,0 +1,401 @@
+"""Low level zip archive functions used by epubmangler"""
+
+# zipfile has no public API for copying a member between archives without decompressing it,
+# so the functions here write local file headers themselves and register the members with
+# the target ZipFile in the same way that ZipFile.open(mode='w') does.
+
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+
+from __future__ import annotations
+
+import copy
+import mimetypes
+import mmap
+import os
+import shutil
+import struct
+import time
+import zlib
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from tempfile import mkstemp
+from typing import Callable, Deque, Iterable, Iterator, NamedTuple, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo
+
+from .globals import STORED_TYPES
+
+# Local file header: signature, versions, flags, method, time, date, crc, sizes, name and
+# extra field lengths
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+
+# Bit 0 of the general purpose flags means that the member is encrypted, and bit 3 means that
+# the sizes and CRC follow the data
+ENCRYPTED_FLAG = 0x01
+DATA_DESCRIPTOR_FLAG = 0x08
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class ArchiveStream:
+    """A write only file object that collects whatever a `ZipFile` writes to it, so that the
+    archive can be sent on in chunks while it is being written. It can't seek, so `ZipFile`
+    writes the sizes and CRC of each member after its data."""
+
+    def __init__(self) -> None:
+
+        self.buffer: bytearray = bytearray()
+
+    def write(self, data: bytes) -> int:
+
+        self.buffer += data
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def chunks(self, size: int, final: bool = False) -> Iterator[bytes]:
+        """Yields, and removes, the data written so far in chunks of `size` bytes. The last,
+        smaller chunk is only yielded if `final` is True."""
+
+        while len(self.buffer) >= size or (final and self.buffer):
+            chunk = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            yield chunk
+
+
+class MappedFile:
+    """A read only file object over a memory mapped archive. Each one has its own position, so
+    several `ZipFile` objects can read the same mapping at once, e.g. from different threads.
+    The mapping is never copied, although `read` returns bytes like any other file does."""
+
+    def __init__(self, mapping: mmap.mmap) -> None:
+
+        self.view: memoryview = memoryview(mapping)
+        self.position: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+
+        end = len(self.view) if size is None or size < 0 else self.position + size
+        data = self.view[self.position:end].tobytes()
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+
+        return self.position
+
+    def seekable(self) -> bool:
+
+        return True
+
+    def close(self) -> None:
+
+        self.view.release()
+
+
+def member_view(mapping: mmap.mmap, info: ZipInfo, source: ZipFile = None) -> memoryview:
+    """Returns the contents of the member `info` of the memory mapped archive `mapping`.
+
+    Stored members, like `mimetype` and most images, are returned as a view of the mapping
+    itself, so nothing is read or copied until the view is used. Deflated members are inflated
+    straight from the mapping. Unlike `ZipFile.read`, the CRC is not checked.
+
+    Members compressed any other way, such as with bzip2 or LZMA, are read with `source.read`.
+    Without `source`, they raise `NotImplementedError`."""
+
+    header = LOCAL_HEADER.unpack_from(mapping, info.header_offset)
+
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile(f'Bad local file header for {info.filename}')
+
+    start = info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1]
+    data = memoryview(mapping)[start:start + info.compress_size]
+
+    if len(data) != info.compress_size:
+        raise BadZipFile(f'Truncated data for {info.filename}')
+
+    if info.flag_bits & ENCRYPTED_FLAG:
+        raise BadZipFile(f'{info.filename} is encrypted')
+
+    if info.compress_type == ZIP_STORED:
+        return data
+
+    if info.compress_type == ZIP_DEFLATED:
+        return memoryview(zlib.decompress(data, -zlib.MAX_WBITS, info.file_size or 16384))
+
+    if source is not None:
+        return memoryview(source.read(info))
+
+    raise NotImplementedError(f'Unsupported compression method for {info.filename}')
+
+
+def member_data_offset(source: ZipFile, info: ZipInfo) -> int:
+    """Returns the offset of the first byte of a member's compressed data in `source`.
+
+    The central directory does not record this, because the extra field in the local file
+    header may differ from the one in the central directory."""
+
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(LOCAL_HEADER.size)
+
+    if len(header) != LOCAL_HEADER.size or header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile(f'Bad local file header for {info.filename}')
+
+    *_fields, name_length, extra_length = LOCAL_HEADER.unpack(header)
+
+    return info.header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+
+def strip_zip64_extra(extra: bytes) -> bytes:
+    """Removes any ZIP64 extended information from an extra field. ZipInfo.FileHeader adds a
+    fresh one when it is needed."""
+
+    stripped = b''
+    position = 0
+
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack('<HH', extra[position:position + 4])
+
+        if header_id != 0x0001:
+            stripped += extra[position:position + 4 + length]
+
+        position += 4 + length
+
+    return stripped
+
+
+def compress_type(name: str) -> int:
+    """Returns how the archive member `name` should be compressed: `mimetype` and the types in
+    `STORED_TYPES` are stored, everything else is deflated."""
+
+    if name == 'mimetype' or mimetypes.guess_type(name)[0] in STORED_TYPES:
+        return ZIP_STORED
+
+    return ZIP_DEFLATED
+
+
+def member_info(name: str, template: ZipInfo | str | os.PathLike = None) -> ZipInfo:
+    """Returns a new `ZipInfo` for the member `name`, compressed as `compress_type` says.
+    `template` is either the `ZipInfo` of an existing member to copy, or a file to take the
+    date and permissions from. Otherwise, the current time is used."""
+
+    if isinstance(template, ZipInfo):
+        info = copy.copy(template)
+        info.filename = name
+        info.flag_bits &= ~DATA_DESCRIPTOR_FLAG  # The sizes and CRC will be known
+        info.extra = strip_zip64_extra(template.extra)
+    elif template is not None:
+        info = ZipInfo.from_file(template, name)
+    else:
+        info = ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o600 << 16  # The same as ZipFile.writestr
+
+    info.compress_type = compress_type(name)
+
+    return info
+
+
+def compress_member(info: ZipInfo, read: Callable[[], bytes],
+                    compresslevel: int | None) -> Tuple[ZipInfo, bytes]:
+    """Reads a member's data with `read` and compresses it as `info` says. Returns `info`,
+    filled in with the sizes and CRC, and the compressed data. zlib releases the GIL while it
+    compresses, so this can be run in several threads at once."""
+
+    data = read()
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data)
+
+    if info.compress_type == ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if compresslevel is None
+                                      else compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+
+    info.compress_size = len(data)
+
+    return info, data
+
+
+def write_raw_member(target: ZipFile, info: ZipInfo, chunks: Iterable[bytes]) -> None:
+    """Writes a member whose sizes and CRC are already in `info` to `target`, which must be open
+    for writing. `chunks` is its data, already compressed as `info` says."""
+
+    with target._lock:  # pylint: disable=protected-access
+        if target._seekable:  # pylint: disable=protected-access
+            target.fp.seek(target.start_dir)
+
+        info.header_offset = target.fp.tell()
+        target._writecheck(info)  # pylint: disable=protected-access
+        target._didModify = True  # pylint: disable=protected-access
+        target.fp.write(info.FileHeader())
+
+        for chunk in chunks:
+            target.fp.write(chunk)
+
+        target.start_dir = target.fp.tell()
+        target.filelist.append(info)
+        target.NameToInfo[info.filename] = info
+
+
+def copy_member(source: ZipFile, target: ZipFile, info: ZipInfo) -> None:
+    """Copies the member `info` from `source` to `target` without decompressing and
+    recompressing it. `target` must be open for writing."""
+
+    new_info = copy.copy(info)
+    new_info.flag_bits &= ~DATA_DESCRIPTOR_FLAG  # The sizes and CRC are already known
+    new_info.extra = strip_zip64_extra(info.extra)
+
+    def chunks() -> Iterator[bytes]:
+        remaining = info.compress_size
+
+        while remaining > 0:
+            data = source.fp.read(min(remaining, COPY_BUFFER_SIZE))
+
+            if not data:
+                raise BadZipFile(f'Truncated data for {info.filename}')
+
+            yield data
+            remaining -= len(data)
+
+    with source._lock:  # pylint: disable=protected-access
+        source.fp.seek(member_data_offset(source, info))
+        write_raw_member(target, new_info, chunks())
+
+
+class Member(NamedTuple):
+    """A member for `write_members` to write. `info` comes from `member_info`, and `read`
+    returns its uncompressed data. If `read` is None, `info` is a member of the source archive
+    that is copied as it is."""
+
+    info: ZipInfo
+    read: Callable[[], bytes] | None = None
+
+
+def write_members(source: ZipFile, target: ZipFile, members: Iterable[Member],
+                  workers: int = 1) -> Iterator[str]:
+    """Writes `members` to `target` in order, yielding the name of each one once it has been
+    written. Members are compressed at `target.compresslevel`.
+
+    If `workers` is more than 1, or None for the number of CPUs, members are read and
+    compressed by that many threads while the ones before them are written, so a full repack
+    uses every core. Only a few members are held in memory at once."""
+
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        for member in members:
+            if member.read is None:
+                copy_member(source, target, member.info)
+            else:
+                info, data = compress_member(member.info, member.read, target.compresslevel)
+                write_raw_member(target, info, (data,))
+
+            yield member.info.filename
+
+        return
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending: Deque[Tuple[ZipInfo, Future | None]] = deque()
+
+        def write_next() -> str:
+            info, future = pending.popleft()
+
+            if future is None:
+                copy_member(source, target, info)
+            else:
+                info, data = future.result()
+                write_raw_member(target, info, (data,))
+
+            return info.filename
+
+        try:
+            for member in members:
+                if member.read is None:
+                    pending.append((member.info, None))
+                else:
+                    pending.append((member.info, executor.submit(
+                        compress_member, member.info, member.read, target.compresslevel)))
+
+                if len(pending) > workers * 2:
+                    yield write_next()
+
+            while pending:
+                yield write_next()
+
+        finally:
+            for _info, future in pending:
+                if future:
+                    future.cancel()
+
+
+def remove_member(zip_file: ZipFile, name: str) -> None:
+    """Removes the member `name` from the central directory of `zip_file`, which must be open in
+    append mode. Its data is left where it is until the archive is compacted."""
+
+    info = zip_file.getinfo(name)
+
+    with zip_file._lock:  # pylint: disable=protected-access
+        zip_file.filelist.remove(info)
+        del zip_file.NameToInfo[name]
+        zip_file._didModify = True  # pylint: disable=protected-access
+
+
+@contextmanager
+def replace_file(path: str | bytes | os.PathLike) -> Iterator[str]:
+    """Yields the name of a temporary file in the same directory as `path`, which is moved over
+    `path` if no exception is raised. The temporary file is removed if one is."""
+
+    path = Path(path)
+    handle, temp = mkstemp(prefix='.epubmangler-', suffix=path.suffix, dir=path.parent)
+    os.close(handle)
+
+    try:
+        shutil.copymode(path, temp)
+        yield temp
+    except BaseException:
+        os.remove(temp)
+        raise
+
+    os.replace(temp, path)
+
+
+def compact(path: str | bytes | os.PathLike) -> None:
+    """Rewrites the archive at `path` without the unused space left behind when members are
+    replaced in place (see `EPub.save`). Members are copied without being decompressed."""
+
+    with replace_file(path) as temp:
+        with ZipFile(path, 'r') as source, ZipFile(temp, 'w') as zip_file:
+            for info in source.infolist():
+                copy_member(source, zip_file, info)
+
+
+def repack(path: str | bytes | os.PathLike, compresslevel: int = None,
+           workers: int = None) -> None:
+    """Rewrites the archive at `path`, decompressing every member and compressing it again at
+    `compresslevel` as `compress_type` says, using `workers` threads (the number of CPUs by
+    default). `mimetype` is moved to the start of the archive and stored, if it isn't already."""
+
+    with replace_file(path) as temp:
+        with ZipFile(path, 'r') as source, \
+             ZipFile(temp, 'w', ZIP_DEFLATED, compresslevel=compresslevel) as zip_file:
+            members = [Member(info) if info.is_dir() else
+                       Member(member_info(info.filename, info), partial(source.read, info))
+                       for info in source.infolist()]
+            members.sort(key=lambda member: member.info.filename != 'mimetype')
+
+            for _name in write_members(source, zip_file, members, workers):
+                pass
@@ -0,0 +1,163 @@
+"""A persistent cache of the metadata of epub files, stored in an SQLite database."""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Dict, List, Self, Type
+
+from .library import read_book
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    metadata TEXT NOT NULL,
+    cover    TEXT,
+    version  TEXT,
+    accessed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_accessed ON books (accessed);
+'''
+
+# The number of access times kept in memory before they are written to the database
+ACCESS_BATCH_SIZE = 1000
+
+
+class MetadataCache:
+    """Stores the metadata, cover image name and EPub version of epub files (see `read_book`),
+    so that files that haven't changed don't need to be opened again.
+
+    Entries are only used while the file's size and mtime are the same as when it was cached.
+    Once there are more than `max_entries`, the least recently used entries are removed.
+    Reading an entry doesn't write to the database: access times are written in batches, by
+    `flush`, `evict` and `close`. The database uses write-ahead logging, so several processes
+    can read it at once."""
+
+    def __init__(self, path: str | bytes | os.PathLike, max_entries: int = 1_000_000) -> Self:
+
+        self.file: str = path
+        self.max_entries: int = max_entries
+        self.connection: sqlite3.Connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        self._puts: int = 0
+        self._accessed: Dict[str, int] = {}  # Access times that haven't been written yet
+
+    def __enter__(self) -> Self:
+
+        return self
+
+    def __exit__(self, _type: Type[BaseException] | None, _value: BaseException | None,
+                 _traceback: TracebackType | None) -> bool:
+
+        self.close()
+        return False  # Raise any thrown exception before exiting
+
+    def __len__(self) -> int:
+
+        return self.connection.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+    def close(self) -> None:
+        """Removes any excess entries and closes the database."""
+
+        self.evict()
+        self.connection.close()
+
+    def flush(self) -> None:
+        """Writes the access times of the entries read since the last flush."""
+
+        if self._accessed:
+            with self.connection:
+                self.connection.executemany(
+                    'UPDATE books SET accessed = ? WHERE path = ?',
+                    [(accessed, key) for key, accessed in self._accessed.items()])
+
+            self._accessed.clear()
+
+    def get(self, path: str | bytes | os.PathLike) -> Dict[str, Any] | None:
+        """Returns the cached entry for `path`, or None if there isn't one or the file has
+        changed since. Entries are dictionaries in the format returned by `read_book`."""
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        key = str(Path(path).absolute())
+
+        row = self.connection.execute(
+            'SELECT metadata, cover, version FROM books '
+            'WHERE path = ? AND size = ? AND mtime_ns = ?',
+            (key, stat.st_size, stat.st_mtime_ns)).fetchone()
+
+        if row is None:
+            return None
+
+        self._accessed[key] = time.time_ns()
+
+        if len(self._accessed) >= ACCESS_BATCH_SIZE:
+            self.flush()
+
+        return {'metadata': json.loads(row[0]), 'cover': row[1], 'version': row[2]}
+
+    def put(self, path: str | bytes | os.PathLike, metadata: List[Dict[str, Any]],
+            cover: str | None = None, version: str | None = None) -> None:
+        """Stores an entry for `path`, replacing any older one."""
+
+        stat = os.stat(path)
+        key = str(Path(path).absolute())
+        self._accessed.pop(key, None)  # Don't overwrite the new access time with an older one
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, stat.st_size, stat.st_mtime_ns, json.dumps(metadata), cover, version,
+                 time.time_ns()))
+
+        self._puts += 1
+
+        if self._puts % 1000 == 0:  # Counting the entries isn't free, so don't do it every time
+            self.evict()
+
+    def load(self, path: str | bytes | os.PathLike) -> Dict[str, Any]:
+        """Returns the cached entry for `path`, reading the file and caching it first if needed.
+        Raises `EPubError` if the file is not a valid epub file."""
+
+        entry = self.get(path)
+
+        if entry is None:
+            entry = read_book(path)
+            self.put(path, **entry)
+
+        return entry
+
+    def invalidate(self, path: str | bytes | os.PathLike = None) -> None:
+        """Removes the entry for `path`, or every entry if `path` is None."""
+
+        with self.connection:
+            if path is None:
+                self.connection.execute('DELETE FROM books')
+            else:
+                self.connection.execute('DELETE FROM books WHERE path = ?',
+                                        (str(Path(path).absolute()),))
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until there are at most `max_entries`."""
+
+        self.flush()
+        excess = len(self) - self.max_entries
+
+        if excess > 0:
+            with self.connection:
+                self.connection.execute(
+                    'DELETE FROM books WHERE path IN '
+                    '(SELECT path FROM books ORDER BY accessed LIMIT ?)', (excess,))
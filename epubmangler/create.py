@@ -0,0 +1,197 @@
+"""Functions that create new epub files."""
+
+# http://idpf.org/epub/30/spec/epub30-publications.html
+# http://idpf.org/epub/20/spec/OPF_2.0_final_spec.html
+# http://www.w3.org/TR/PNG/
+
+from __future__ import annotations
+
+import math
+import os
+import random
+import struct
+import uuid
+import zlib
+
+from typing import List
+from xml.sax.saxutils import escape
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+
+CONTAINER = '''<?xml version="1.0" encoding="utf-8"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+'''
+
+OPF = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="{version}" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+{metadata}
+  </metadata>
+  <manifest>
+{manifest}
+  </manifest>
+  <spine{toc}>
+{spine}
+  </spine>
+</package>
+'''
+
+CHAPTER = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+{text}
+</body>
+</html>
+'''
+
+NAV = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Contents</title></head>
+<body>
+<nav epub:type="toc"><ol>
+{items}
+</ol></nav>
+</body>
+</html>
+'''
+
+NCX = '''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+<head><meta name="dtb:uid" content="{identifier}"/></head>
+<docTitle><text>{title}</text></docTitle>
+<navMap>
+{items}
+</navMap>
+</ncx>
+'''
+
+WORDS = ('the', 'monster', 'laboratory', 'lightning', 'glacier', 'creature', 'science', 'and',
+         'of', 'night', 'horror', 'Geneva', 'letter', 'sister', 'ship', 'ice', 'a', 'was')
+
+
+def png_image(size: int, seed: int = 0) -> bytes:
+    """Returns a valid PNG image of random noise that is roughly `size` bytes long. Noise does
+    not compress, so this behaves like a typical cover photo."""
+
+    side = max(1, int(math.sqrt(size / 3)))
+    generator = random.Random(seed)
+    rows = b''.join(b'\x00' + generator.randbytes(side * 3) for _row in range(side))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data)))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows, 1)) +
+            chunk(b'IEND', b''))
+
+
+def random_paragraphs(generator: random.Random, size: int) -> List[str]:
+    """Returns paragraphs of random words, `<p>` tags included, adding up to at least `size`
+    bytes."""
+
+    text = []
+    length = 0
+
+    while length < size:
+        paragraph = ' '.join(generator.choice(WORDS) for _word in range(60))
+        text.append(f'<p>{paragraph}</p>')
+        length += len(text[-1])
+
+    return text
+
+
+def create_epub(path: str | bytes | os.PathLike, version: str = '3.0', title: str = 'Untitled',
+                creator: str = 'Anonymous', language: str = 'en', chapters: int = 1,
+                chapter_size: int = 0, subjects: int = 0, cover_size: int = 0,
+                members: int = 0, member_size: int = 0, seed: int = 0) -> None:
+    """Creates a new, valid epub file at `path`. `version` can be '2.0' or '3.0'.
+
+    The book has `chapters` XHTML files containing roughly `chapter_size` bytes of text each,
+    plus `subjects` dc:subject elements in its metadata. If `cover_size` is not 0, a PNG cover
+    image of roughly that many bytes is added too.
+
+    `members` extra files of roughly `member_size` bytes each are added to the archive, but not
+    to the manifest, so the number of files in the archive can be changed without changing the
+    size of the OPF file. `seed` makes the random text and images
+    repeatable. These make it easy to create books of any shape for testing and benchmarks."""
+
+    if version not in ('2.0', '3.0'):
+        raise ValueError(f"Unsupported EPub version: '{version}'")
+
+    generator = random.Random(seed)
+    identifier = f'urn:uuid:{uuid.UUID(int=generator.getrandbits(128))}'
+
+    metadata = [f'    <dc:identifier id="id">{identifier}</dc:identifier>',
+                f'    <dc:title>{escape(title)}</dc:title>',
+                f'    <dc:creator opf:role="aut">{escape(creator)}</dc:creator>',
+                f'    <dc:language>{escape(language)}</dc:language>']
+    metadata += [f'    <dc:subject>Subject {number}</dc:subject>'
+                 for number in range(1, subjects + 1)]
+    manifest = []
+    spine = []
+    files = {}
+
+    if version == '3.0':
+        metadata.append('    <meta property="dcterms:modified">2000-01-01T00:00:00Z</meta>')
+        manifest.append('    <item id="nav" href="nav.xhtml" '
+                        'media-type="application/xhtml+xml" properties="nav"/>')
+    else:
+        metadata.append('    <dc:date opf:event="publication">2000-01-01</dc:date>')
+        manifest.append('    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>')
+
+    if cover_size:
+        if version == '3.0':
+            manifest.append('    <item id="cover-image" href="cover.png" media-type="image/png" '
+                            'properties="cover-image"/>')
+        else:
+            metadata.append('    <meta name="cover" content="cover-image"/>')
+            manifest.append('    <item id="cover-image" href="cover.png" '
+                            'media-type="image/png"/>')
+
+        files['OEBPS/cover.png'] = png_image(cover_size, seed)
+
+    for number in range(1, chapters + 1):
+        text = random_paragraphs(generator, chapter_size)
+        name = f'chapter{number}.xhtml'
+        manifest.append(f'    <item id="chapter{number}" href="{name}" '
+                        'media-type="application/xhtml+xml"/>')
+        spine.append(f'    <itemref idref="chapter{number}"/>')
+        files[f'OEBPS/{name}'] = CHAPTER.format(title=f'Chapter {number}', text='\n'.join(text))
+
+    for number in range(1, members + 1):
+        text = random_paragraphs(generator, member_size)
+        files[f'OEBPS/extra/file{number}.txt'] = '\n'.join(text)
+
+    if version == '3.0':
+        items = '\n'.join(f'<li><a href="chapter{number}.xhtml">Chapter {number}</a></li>'
+                          for number in range(1, chapters + 1))
+        files['OEBPS/nav.xhtml'] = NAV.format(items=items)
+    else:
+        items = '\n'.join(f'<navPoint id="point{number}" playOrder="{number}"><navLabel><text>'
+                          f'Chapter {number}</text></navLabel>'
+                          f'<content src="chapter{number}.xhtml"/></navPoint>'
+                          for number in range(1, chapters + 1))
+        files['OEBPS/toc.ncx'] = NCX.format(identifier=identifier, title=escape(title),
+                                            items=items)
+
+    files['OEBPS/content.opf'] = OPF.format(version=version, metadata='\n'.join(metadata),
+                                            manifest='\n'.join(manifest),
+                                            spine='\n'.join(spine),
+                                            toc='' if version == '3.0' else ' toc="ncx"')
+
+    with ZipFile(path, 'w', ZIP_DEFLATED) as zip_file:
+        # mimetype must be the first file and must not be compressed
+        zip_file.writestr('mimetype', 'application/epub+zip', ZIP_STORED)
+        zip_file.writestr('META-INF/container.xml', CONTAINER)
+
+        for name, data in files.items():
+            # Images are already compressed
+            zip_file.writestr(name, data, ZIP_STORED if name.endswith('.png') else ZIP_DEFLATED)
@@ -14,31 +14,65 @@
 
 from __future__ import annotations
 
+import bisect
 import mimetypes
+import mmap
 import os
+import posixpath
 import pprint
 import shutil
 import time
 import xml.etree.ElementTree as ET
+from contextlib import ExitStack, contextmanager
+from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory as TempDir
 from types import TracebackType
-from typing import Dict, List, Self, Sequence, Type
-from zipfile import ZIP_DEFLATED, ZipFile
-
+from typing import Any, BinaryIO, Dict, Iterator, List, Self, Sequence, Set, Tuple, Type
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo
+
+from .archive import (
+    COPY_BUFFER_SIZE,
+    ArchiveStream,
+    MappedFile,
+    Member,
+    compress_member,
+    compress_type,
+    member_info,
+    member_view,
+    remove_member,
+    replace_file,
+    write_members,
+    write_raw_member,
+)
 from .functions import (
+    EPubError,
+    element_to_dict,
     find_opf_files,
-    is_epub,
+    map_epub,
+    open_epub,
     namespaced_text,
+    read_image,
+    serialize_opf,
     strip_illegal_chars,
-    strip_namespace,
     strip_namespaces,
+    xpath_key,
 )
 from .globals import IMAGE_TYPES, NAMESPACES, TIME_FORMAT, XPATHS
+from .hooks import emit_event, hook_timer
+
+
+class _SharedTempDir:
+    """The temporary directory of an unpickled EPub. It belongs to the EPub that was pickled,
+    which removes it, so `cleanup` does nothing."""
+
+    def __init__(self, name: str) -> Self:
+
+        self.name = name
 
+    def cleanup(self) -> None:
 
-class EPubError(Exception):
-    """Exception that is raised when an error occurs during an `EPub` method."""
+        pass
 
 
 # Use @property notation for editable fields
@@ -46,33 +80,270 @@ class EPubError(Exception):
 class EPub:
     """A Python object representing an epub ebook's editable metadata."""
 
-    def __init__(self, path: str | bytes | os.PathLike) -> Self:
-        """Open an epub file and load its metadata into memory for editing."""
+    def __init__(self, path: str | bytes | os.PathLike, lazy: bool = False,
+                 mapped: bool = False) -> Self:
+        """Open an epub file and load its metadata into memory for editing.
+
+        If `lazy` is True, only `META-INF/container.xml` and the OPF file are read from the
+        archive. Other files are extracted one at a time when a method needs them, for instance
+        `get_cover`. Use `extract` to extract the rest of the archive later on.
+
+        If `mapped` is True, the file is memory mapped and the archive is read from the mapping
+        rather than with `read` calls. Stored members, such as most cover images, are used
+        straight from the mapping without being copied (see `get_cover_bytes`). Processes that
+        open the same file share the mapped pages."""
 
         self.etree: ET.ElementTree = None
+        self.extracted: Dict[str, Tuple[int, int]] = {}
         self.file: str = path
+        self.index: Dict[Tuple[str, str | None, str | None], List[ET.Element]] = {}
+        self.lazy: bool = lazy
+        self.mapping: mmap.mmap = None
         self.metadata: List[ET.Element] = []
         self.modified: bool = False
         self.opf: str = None
+        self.opf_name: str = None
+        self.replaced: Set[str] = set()
         self.root: ET.Element = None
         self.tempdir: TempDir = None
 
-        if not is_epub(path):
-            raise EPubError(f"{self.file} is not a valid .epub file.")
+        self._batch: Dict[str, Any] = None  # See batch()
+
+        if mapped:
+            self.mapping = map_epub(path)
 
-        self.tempdir = TempDir(prefix='epubmangler-')  # pylint: disable=consider-using-with
-        # TempDir.cleanup() is called in __del__()
+        # The archive is only opened once to check it, extract it and read the OPF file
+        with open_epub(path, self.mapping) as zip_file:
+            if not lazy:
+                start = hook_timer()
+                self._make_tempdir()
+                zip_file.extractall(self.tempdir.name)
 
-        with ZipFile(self.file, 'r', ZIP_DEFLATED) as zip_file:
-            zip_file.extractall(self.tempdir.name)
+                for name in zip_file.namelist():
+                    self._record_extracted(name)
 
-        self.parse_opf()
+                if start is not None:
+                    emit_event('extract', start, path,
+                               sum(info.file_size for info in zip_file.infolist()))
+
+            self.parse_opf(zip_file=zip_file)
 
     def __del__(self) -> None:
 
         if self.tempdir:
             self.tempdir.cleanup()
 
+        self._unmap()
+
+    def _open_archive(self) -> ZipFile:
+        """Opens the original archive for reading, from the memory mapping if there is one."""
+
+        start = hook_timer()
+        zip_file = ZipFile(MappedFile(self.mapping) if self.mapping else self.file, 'r',
+                           ZIP_DEFLATED)
+
+        if start is not None:
+            emit_event('zip_open', start, self.file,
+                       len(self.mapping) if self.mapping else os.path.getsize(self.file))
+
+        return zip_file
+
+    def _unmap(self) -> None:
+
+        if self.mapping:
+            try:
+                self.mapping.close()
+            except BufferError:  # Views of it are still in use, it is closed when they are gone
+                pass
+
+            self.mapping = None
+
+    def _make_tempdir(self) -> None:
+
+        if not self.tempdir:
+            self.tempdir = TempDir(prefix='epubmangler-')  # pylint: disable=consider-using-with
+            # TempDir.cleanup() is called in __del__()
+
+    def _record_extracted(self, name: str) -> None:
+        """Remembers the size and mtime of an extracted file, so that `save` can tell whether
+        it has been changed since."""
+
+        path = Path(self.tempdir.name, name)
+
+        if path.is_file():
+            stat = path.stat()
+            self.extracted[name] = (stat.st_size, stat.st_mtime_ns)
+
+    def _is_unchanged(self, name: str) -> bool:
+        """Returns True if the extracted copy of archive member `name` has not been modified."""
+
+        if name in self.replaced:
+            return False
+
+        path = Path(self.tempdir.name, name)
+        stat = path.stat()
+
+        return self.extracted.get(name) == (stat.st_size, stat.st_mtime_ns)
+
+    def _member_path(self, name: str) -> Path:
+        """Returns the path that the archive member `name` has in the temporary directory. The
+        directory is created if needed, but nothing is extracted."""
+
+        self._make_tempdir()
+        path = Path(self.tempdir.name, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        return path
+
+    def _extract_member(self, name: str) -> Path:
+        """Returns the path of the archive member `name` in the temporary directory, extracting
+        it first if the book was opened with `lazy=True`."""
+
+        path = self._member_path(name)
+
+        if self.lazy and not path.exists():
+            with self._open_archive() as zip_file:
+                if name in zip_file.namelist():
+                    start = hook_timer()
+                    path = Path(zip_file.extract(name, self.tempdir.name))
+                    self._record_extracted(name)
+                    emit_event('extract', start, self.file, zip_file.getinfo(name).file_size)
+
+        return path
+
+    def _write_member(self, source: str | os.PathLike | bytes, name: str) -> None:
+        """Copies the file `source`, or writes the data `source`, over the archive member `name`
+        in the temporary directory. Inside `batch` this waits until the batch is committed."""
+
+        if self._batch is not None:
+            self._batch['files'].append((source, name))
+            return
+
+        path = self._member_path(name)
+
+        if path.exists():
+            os.remove(path)
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            path.write_bytes(source)
+        else:
+            shutil.copy(source, path)
+
+        self.replaced.add(name)
+
+    def _mark_modified(self) -> None:
+
+        if self._batch is None:
+            self.modified = True
+        else:
+            self._batch['modified'] = True
+
+    @contextmanager
+    def batch(self) -> Iterator[Self]:
+        """Makes a group of changes in one go:
+
+        `with book.batch():`
+            `book.set('title', 'Frankenstein 2')`
+            `book.add('contributor', 'epubmangler', {'opf:role' : 'bkp'})`
+
+        The checks for duplicate elements made by `add`, copying cover images and setting
+        `modified` all wait until the end of the block. If an exception is raised inside the
+        block, or a check fails, every change made inside it is undone and the exception is
+        raised again. Batches inside a batch are part of the outer one."""
+
+        if self._batch is not None:
+            yield self
+            return
+
+        metadata = self.root.find('./opf:metadata', NAMESPACES)
+        manifest = self.root.find('./opf:manifest', NAMESPACES)
+        elements = [(element, element.text, element.tail, dict(element.attrib))
+                    for element in metadata]
+        items = list(manifest)
+
+        self._batch = {'added': [], 'files': [], 'modified': False}
+
+        try:
+            yield self
+
+            for name, element in self._batch['added']:
+                if element in self.index.get((element.tag, None, None), []):
+                    self._check_duplicate(name, element.attrib, element)
+
+        except BaseException:
+            for element, text, tail, attrib in elements:
+                element.text, element.tail, element.attrib = text, tail, attrib
+
+            metadata[:] = [element for element, *_values in elements]
+            manifest[:] = items
+            self.reindex()
+            raise
+
+        finally:
+            batch, self._batch = self._batch, None
+
+        for source, name in batch['files']:
+            self._write_member(source, name)
+
+        if batch['modified']:
+            self.modified = True
+
+    # The next methods keep self.metadata and self.index up to date. The index maps the keys
+    # returned by xpath_key to the matching elements, in document order, so that the XPATHS in
+    # get and get_all can be looked up without searching the tree.
+
+    def _element_keys(self, element: ET.Element) -> List[Tuple[str, str | None, str | None]]:
+
+        return [(element.tag, None, None)] + [(element.tag, key, value)
+                                              for key, value in element.attrib.items()]
+
+    def _index_element(self, element: ET.Element) -> None:
+        """Adds an element that has just been appended to the metadata section."""
+
+        self.metadata.append(element)
+
+        for key in self._element_keys(element):
+            self.index.setdefault(key, []).append(element)
+
+    def _unindex_element(self, element: ET.Element) -> None:
+        """Removes an element that has just been removed from the metadata section."""
+
+        self.metadata.remove(element)
+
+        for key in self._element_keys(element):
+            self.index[key].remove(element)
+
+    def _reindex_element(self, element: ET.Element, old_attrib: Dict[str, str]) -> None:
+        """Updates the index after the attributes of `element` have been changed."""
+
+        for key, value in old_attrib.items():
+            self.index[(element.tag, key, value)].remove(element)
+
+        for key, value in element.attrib.items():
+            elements = self.index.setdefault((element.tag, key, value), [])
+            bisect.insort(elements, element, key=self.metadata.index)
+
+    def reindex(self) -> None:
+        """Rebuilds `metadata` and `index` from the tree. This is only needed if elements are
+        added, removed or have their attributes changed without using EPub's methods."""
+
+        self.metadata = []
+        self.index = {}
+
+        for element in self.root.findall('./opf:metadata/*', NAMESPACES):
+            self._index_element(element)
+
+    def _find(self, xpath: str) -> List[ET.Element]:
+        """Returns the elements matching one of the xpaths in XPATHS, using the index if the
+        xpath is simple enough. The list must not be modified."""
+
+        key = xpath_key(xpath)
+
+        if key is None:
+            return self.root.findall(xpath, NAMESPACES)
+
+        return self.index.get(key, [])
+
     # The next two methods enable context manager support
 
     def __enter__(self) -> Self:
@@ -85,6 +356,27 @@ class EPub:
         self.__del__()
         return False  # Raise any thrown exception before exiting
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """Books can be pickled, for instance to be saved in another process. The copy uses the
+        same temporary directory, but doesn't remove it, so the original should outlive it. The
+        memory mapping isn't copied; the copy maps the file again."""
+
+        state = self.__dict__.copy()
+        state['mapping'] = self.mapping is not None
+        state['tempdir'] = self.tempdir.name if self.tempdir else None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+
+        mapped, tempdir = state['mapping'], state['tempdir']
+        self.__dict__.update(state, mapping=None, tempdir=None)
+
+        if tempdir:
+            self.tempdir = _SharedTempDir(tempdir)
+
+        if mapped:
+            self.mapping = map_epub(self.file)
+
     # The next two methods make the object subscriptable like a Dict
 
     def __getitem__(self, name: str) -> ET.Element:
@@ -98,69 +390,76 @@ class EPub:
         except EPubError:
             self.add(name, text)
 
+    @property
+    def version(self) -> str:
+        """The EPub version of the book. This is usually '2.0' or '3.0'."""
+
+        return self.root.attrib.get('version', '')
+
     def __repr__(self) -> str:
 
-        items = []
+        return pprint.pformat([element_to_dict(element) for element in self.metadata])
 
-        for element in self.metadata:
-            items.append({'tag': strip_namespace(element.tag),
-                          'text': element.text if element.text else '',
-                          'attrib': strip_namespaces(element.attrib)})
+    def _check_duplicate(self, name: str, attrib: Dict[str, str],
+                         element: ET.Element = None) -> None:
+        """Raises EPubError if an element other than `element` matches `name` and `attrib`."""
 
-        return pprint.pformat(items)
+        for meta in self.get_all(name):
+            if meta is not element and strip_namespaces(meta.attrib) == strip_namespaces(attrib):
+                raise EPubError(f"{Path(self.file).name} already has an \
+                                identical element. It is usually incorrect to have \
+                                more than one of most elements.")
 
     def add(self, name: str, text: str, attrib: Dict[str, str] = None) -> None:
         """Adds a new element to the metadata section of the tree."""
 
-        try:
-            for meta in self.get_all(name):
-                if strip_namespaces(meta.attrib) == strip_namespaces(attrib):
-                    raise EPubError(f"{Path(self.file).name} already has an \
-                                    identical element. It is usually incorrect to have \
-                                    more than one of most elements.")
-        except NameError:
-            pass
-
         element = ET.Element(namespaced_text(f'dc:{name}'))
         element.text = text
         if attrib:
             element.attrib = attrib
 
-        self.etree.find('./opf:metadata', NAMESPACES).append(element)
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        if self._batch is None:
+            self._check_duplicate(name, attrib)
+        else:  # Checked when the batch is committed
+            self._batch['added'].append((name, element))
+
+        self.root.find('./opf:metadata', NAMESPACES).append(element)
+        self._index_element(element)
+        self._mark_modified()
 
-    def add_cover(self, path: str | bytes | os.PathLike) -> None:
-        """Adds a cover element and the required additional metadata."""
+    def add_cover(self, path: str | os.PathLike | bytes | BinaryIO) -> None:
+        """Adds a cover element and the required additional metadata. `path` can also be the
+        contents of the image file, or a readable binary file object."""
 
         if self.has_element('cover'):
             raise EPubError(f"{Path(self.file).name} already has a cover. Use \
                             set_cover if you want to change it")
 
-        mime = mimetypes.guess_type(path)[0]
+        source, mime = read_image(path)
 
-        if mime not in IMAGE_TYPES or not Path(path).exists():
+        if mime not in IMAGE_TYPES:
             raise EPubError(f"{Path(self.file).name} is not a valid image file.")
 
-        filename = Path(Path(self.opf).parent, f'cover{Path(path).suffix}')
-        shutil.copy(path, filename)
+        suffix = Path(path).suffix if isinstance(source, Path) else mimetypes.guess_extension(mime)
+        name = posixpath.join(posixpath.dirname(self.opf_name), f'cover{suffix}')
+        self._write_member(source, name)
 
-        metadata_element = ET.Element('meta')
-        manifest_element = ET.Element('item')
+        metadata_element = ET.Element(namespaced_text('opf:meta'))
+        manifest_element = ET.Element(namespaced_text('opf:item'))
 
-        if self.root.attrib['version'] == '3.0':
+        if self.version == '3.0':
             metadata_element.attrib = {'name': 'cover', 'content': 'cover-image'}
             manifest_element.attrib = {'id': 'cover-image', 'properties': 'cover-image',
-                                       'href': filename.name, 'media-type': mime}
+                                       'href': posixpath.basename(name), 'media-type': mime}
         else:
             metadata_element.attrib = {'name': 'cover', 'content': 'cover'}
-            manifest_element.attrib = {'id': 'cover', 'href': filename.name,
+            manifest_element.attrib = {'id': 'cover', 'href': posixpath.basename(name),
                                        'media-type': mime}
 
-        self.etree.find('./opf:metadata', NAMESPACES).append(metadata_element)
-        self.etree.find('./opf:manifest', NAMESPACES).append(manifest_element)
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        self.root.find('./opf:metadata', NAMESPACES).append(metadata_element)
+        self.root.find('./opf:manifest', NAMESPACES).append(manifest_element)
+        self._index_element(metadata_element)
+        self._mark_modified()
 
     def add_subject(self, name: str) -> None:
         """Adds a subject to the tree. This will do nothing if the subject already exists."""
@@ -172,9 +471,9 @@ class EPub:
         element = ET.Element(namespaced_text('dc:subject'))
         element.text = name
 
-        self.etree.find('./opf:metadata', NAMESPACES).append(element)
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        self.root.find('./opf:metadata', NAMESPACES).append(element)
+        self._index_element(element)
+        self._mark_modified()
 
     def get(self, name: str) -> ET.Element:
         """This will return the first matching element. Use get_all if you expect
@@ -188,8 +487,9 @@ class EPub:
             raise EPubError(f"Unrecognized element: '{name}'") from key_error
 
         for xpath in xpaths:
-            element = self.root.find(xpath, NAMESPACES)
-            if element is not None:
+            elements = self._find(xpath)
+            if elements:
+                element = elements[0]
                 break
 
         if element is None:
@@ -209,14 +509,13 @@ class EPub:
             raise EPubError(f"Unrecognized element: '{name}'") from key_error
 
         for xpath in xpaths:
-            # ET.Element can evaluate as False, so we need test that element is not None
-            for e in self.root.findall(xpath, NAMESPACES):
-                elements.append(e) if e is not None else ...
-        
+            elements.extend(self._find(xpath))
+
         return elements
 
     def get_cover(self) -> str:
-        """Returns the full path of the cover image in the temporary directory.
+        """Returns the full path of the cover image in the temporary directory. Books opened
+        with `lazy=True` only extract the cover image itself.
 
         `./opf:manifest/opf:item/[@properties=\"cover-image\"]` contains the local path to the
         image in EPub version 3 files.
@@ -228,7 +527,39 @@ class EPub:
         `./opf:manifest/opf:item/[@id=content]` gives us an element with a `href` element that
         points to the cover file."""
 
-        based = Path(self.opf).parent
+        name = self.get_cover_name()
+
+        return self._extract_member(name) if name else None
+
+    def get_cover_bytes(self) -> memoryview:
+        """Returns the contents of the cover image, or None if the book has no cover. See
+        `open_cover`. Books opened with `mapped=True` return a view of the memory mapped archive
+        when the cover is stored uncompressed, so the image is not copied at all."""
+
+        name = self.get_cover_name()
+
+        if self.mapping and name and (not self.tempdir or
+                                      not Path(self.tempdir.name, name).exists() or
+                                      self._is_unchanged(name)):
+            with self._open_archive() as zip_file:
+                try:
+                    return member_view(self.mapping, zip_file.getinfo(name), zip_file)
+                except KeyError:  # The manifest points to a file that doesn't exist
+                    return None
+
+        cover = self.open_cover()
+
+        if cover is None:
+            return None
+
+        with cover:
+            return memoryview(cover.read())
+
+    def get_cover_name(self) -> str:
+        """Returns the name of the cover image in the archive, without extracting it. See
+        `get_cover` for how it is found."""
+
+        based = posixpath.dirname(self.opf_name)
 
         def epub2() -> str:
             # Iterate over all <meta name="cover"> elements. Some ebooks that have had their cover
@@ -240,17 +571,17 @@ class EPub:
                     try:
                         name = self.root.find(f"./opf:manifest/opf:item/[@id=\"{element}\"]",
                                             NAMESPACES).attrib['href']
-                        return Path(based, name)
+                        return posixpath.normpath(posixpath.join(based, name))
                     except AttributeError:
                         pass
 
             return None
 
-        if self.root.attrib['version'] == '3.0':
+        if self.version == '3.0':
             try:
                 name = self.root.find("./opf:manifest/opf:item/[@properties=\"cover-image\"]",
                                       NAMESPACES).attrib['href']
-                return Path(based, name)
+                return posixpath.normpath(posixpath.join(based, name))
             except AttributeError: # Some books still define the cover the old way
                 return epub2()
 
@@ -260,7 +591,32 @@ class EPub:
     def has_element(self, name: str) -> bool:
         """Returns True if the EPub has a matching element. Otheriwse, returns False."""
 
-        return bool(self.get(name))
+        try:
+            xpaths = XPATHS[name]
+        except KeyError as key_error:
+            raise EPubError(f"Unrecognized element: '{name}'") from key_error
+
+        # ET.Element can evaluate as False, so don't test the element itself
+        return any(self._find(xpath) for xpath in xpaths)
+
+    def open_cover(self) -> BinaryIO:
+        """Returns the cover image as a readable binary file object, or None if the book has no
+        cover. Unless the cover has been replaced, it is read straight from the archive without
+        being extracted. Close it when you are done."""
+
+        name = self.get_cover_name()
+
+        if not name:
+            return None
+
+        if self.tempdir and Path(self.tempdir.name, name).exists():
+            return open(Path(self.tempdir.name, name), mode='rb')
+
+        with self._open_archive() as zip_file:  # The member keeps the file open until closed
+            try:
+                return zip_file.open(name)
+            except KeyError:  # The manifest points to a file that doesn't exist
+                return None
 
     def remove(self, name: str, attrib: Dict[str, str] = None) -> None:
         """Removes an element from the tree. Books can have more than one date or creator element.
@@ -273,12 +629,13 @@ class EPub:
                 for element in elements:
                     if attrib == strip_namespaces(element.attrib):
                         self.root.find('./opf:metadata', NAMESPACES).remove(element)
+                        self._unindex_element(element)
 
             else:
                 self.root.find('./opf:metadata', NAMESPACES).remove(elements[0])
+                self._unindex_element(elements[0])
 
-            self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-            self.modified = True
+            self._mark_modified()
 
     def remove_subject(self, name: str) -> None:
         """Removes a subject element from the tree."""
@@ -286,9 +643,9 @@ class EPub:
         for subject in self.get_all('subject'):
             if subject.text == name:
                 self.root.find('./opf:metadata', NAMESPACES).remove(subject)
+                self._unindex_element(subject)
 
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        self._mark_modified()
 
     def set(self, name: str, text: str, attrib: Dict[str, str] = None) -> None:
         """Sets the text and attributes of an existing element."""
@@ -309,30 +666,31 @@ class EPub:
 
             if not found:
                 element = elements[0]
+                old_attrib = element.attrib
                 element.text = text
                 element.attrib = attrib
+                self._reindex_element(element, old_attrib)
 
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        self._mark_modified()
 
-    def set_cover(self, path: str | bytes | os.PathLike) -> None:
-        """Replaces the cover image of the book with `path`, provided it is valid image file."""
+    def set_cover(self, path: str | os.PathLike | bytes | BinaryIO) -> None:
+        """Replaces the cover image of the book with `path`, provided it is valid image file.
+        `path` can also be the contents of the image file, or a readable binary file object."""
 
-        mime = mimetypes.guess_type(path)[0]
-        cover = self.get_cover()
+        source, mime = read_image(path)
+        name = self.get_cover_name()
 
-        if mime in IMAGE_TYPES and Path(path).exists() and cover:
-            os.remove(cover)
-            shutil.copy(path, cover)
+        if mime in IMAGE_TYPES and name:
+            self._write_member(source, name)
 
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        self._mark_modified()
 
     def set_identifier(self, name: str, scheme: str | None) -> None:
         """Sets the epub's identifier. This is generally the book's ISBN or a URI."""
 
         id_num = self.root.attrib['unique-identifier']
         element = self.root.find(f"./opf:metadata/dc:identifier/[@id=\"{id_num}\"]", NAMESPACES)
+        old_attrib = dict(element.attrib)
         element.text = name
 
         if not scheme:
@@ -351,78 +709,354 @@ class EPub:
 
         element.attrib['opf:scheme'] = scheme
 
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = True
+        self._reindex_element(element, old_attrib)
+        self._mark_modified()
 
     def extend(self, metadata: Sequence[ET.Element]) -> None:
         """Extends the current metadata by appending elements from `metadata`."""
 
         self.root.find('./opf:metadata', NAMESPACES).extend(metadata)
-        self.metadata.extend(metadata)
-        self.modified = True
+
+        for element in metadata:
+            self._index_element(element)
+
+        self._mark_modified()
 
     def update(self, metadata: Sequence[ET.Element]) -> None:
         """Replace the entirety of the metadata section of the tree with `metadata`."""
 
         self.root.find('./opf:metadata', NAMESPACES).clear()
+        self.metadata = []
+        self.index = {}
         self.extend(metadata)
 
-    def parse_opf(self, modified: bool = False) -> None:
+    def parse_opf(self, modified: bool = False, zip_file: ZipFile = None) -> None:
         """Loads the opf file into memory. This is used on initialization, and may be of use
-        if the file is edited from another process."""
+        if the file is edited from another process.
+
+        Books opened with `lazy=True` read the OPF file straight from the archive, using
+        `zip_file` if it is already open."""
+
+        start = hook_timer()
+
+        if self.lazy:
+            if zip_file:
+                size = self._read_opf(zip_file)
+            else:
+                with open_epub(self.file, self.mapping) as zip_file:
+                    size = self._read_opf(zip_file)
+
+        else:
+            try:
+                self.opf = find_opf_files(self.tempdir.name)[0]
+            except (IndexError, ET.ParseError, UnicodeDecodeError) as error:
+                # No OPF found, or container.xml is malformed
+                raise EPubError(f"{self.file} is not a valid .epub file.") from error
+
+            self.opf_name = Path(self.opf).relative_to(self.tempdir.name).as_posix()
+
+            try:
+                self.etree = ET.parse(self.opf)
+            except ET.ParseError as parse_error:  # XML error
+                raise EPubError(f"{self.file} is not a valid .epub file.") from parse_error
+
+            size = os.path.getsize(self.opf) if start is not None else 0
+
+        self.root = self.etree.getroot()
+        self.reindex()
+        self.modified = modified
+        emit_event('parse_opf', start, self.file, size)
+
+    def _read_opf(self, zip_file: ZipFile) -> int:
+        """Parses the OPF file straight from `zip_file`, and returns its uncompressed size."""
 
         try:
-            self.opf = find_opf_files(self.tempdir.name)[0]
-        except IndexError as index_error:  # No OPF found
-            raise EPubError(f"{self.file} is not a valid .epub file.") from index_error
+            self.opf_name = find_opf_files(zip_file)[0]
+            info = zip_file.getinfo(self.opf_name)
+        except (IndexError, KeyError, ET.ParseError, UnicodeDecodeError) as error:
+            # No container.xml or OPF found, or container.xml is malformed
+            raise EPubError(f"{self.file} is not a valid .epub file.") from error
 
         try:
-            self.etree = ET.parse(self.opf)
-        except ET.ParseError as parse_error:  # XML error
+            if self.mapping:  # Parsed straight from the mapping, after inflating it if needed
+                parser = ET.XMLParser()
+                parser.feed(member_view(self.mapping, info, zip_file))
+                self.etree = ET.ElementTree(parser.close())
+            else:
+                with zip_file.open(info) as source:
+                    self.etree = ET.parse(source)
+        except (ET.ParseError, BadZipFile) as parse_error:  # XML or archive error
             raise EPubError(f"{self.file} is not a valid .epub file.") from parse_error
 
-        self.root = self.etree.getroot()
-        self.metadata = self.root.findall('./opf:metadata/*', NAMESPACES)
-        self.modified = modified
+        return info.file_size
+
+    def extract(self) -> None:
+        """Extracts the rest of a book that was opened with `lazy=True` to the temporary
+        directory. Files that have already been extracted or replaced are left alone. The book
+        behaves as though it was opened normally afterwards."""
 
-    def save(self, path: str | bytes | os.PathLike, overwrite: bool = False) -> None:
+        if not self.lazy:
+            return
+
+        self._make_tempdir()
+        start = hook_timer()
+        size = 0
+
+        with self._open_archive() as zip_file:
+            for info in zip_file.infolist():
+                if not Path(self.tempdir.name, info.filename).exists():
+                    zip_file.extract(info, self.tempdir.name)
+                    self._record_extracted(info.filename)
+                    size += info.file_size
+
+        emit_event('extract', start, self.file, size)
+
+        self.opf = str(Path(self.tempdir.name, self.opf_name))
+        self.lazy = False
+
+    def save(self, path: str | bytes | os.PathLike | BinaryIO, overwrite: bool = False,
+             append: bool = True, repack: bool = False, compresslevel: int = None,
+             workers: int = None) -> None:
         """Saves the opened EPub with the modified metadata to the file specified in `path`.
-        If you want to overwrite an existing file set `overwrite=True`."""
+        If you want to overwrite an existing file set `overwrite=True`. `path` can also be a
+        writable binary file object, such as `io.BytesIO` or a socket file, which is left open.
+
+        Files that have not changed are copied from the original archive without being
+        decompressed. Only the OPF file and any replaced or added files are compressed.
+
+        When `path` is the file that the book was opened from, the changed files are appended
+        to the end of it and only the central directory is rewritten. The old copies are left
+        in the file as unused space until it is compacted, either with `compact` or by saving
+        with `append=False`. The file is damaged if this is interrupted part way through.
+
+        If `repack` is True, every file is decompressed and compressed again instead, by
+        `workers` threads (the number of CPUs by default). New and repacked files are deflated
+        at `compresslevel`, 0 to 9, or zlib's default if it is None. Images and other files that
+        are already compressed are stored as they are (see `STORED_TYPES`)."""
+
+        workers = workers or (os.cpu_count() if repack else 1)
+
+        if hasattr(path, 'write'):
+            opf = self._prepare_save()
+            start = hook_timer()
+            position = path.tell() if start is not None and path.seekable() else None
+
+            with self._open_archive() as source, \
+                 ZipFile(path, 'w', ZIP_DEFLATED, compresslevel=compresslevel) as zip_file:
+                for _name in self._write_archive(source, zip_file, opf, repack, workers):
+                    pass
+
+            emit_event('zip_write', start, self.file,
+                       path.tell() - position if position is not None else 0)
+            self.modified = False
+            return
 
         path = Path(strip_illegal_chars(path))
 
         if path.exists() and not overwrite:
             raise FileExistsError(f"{path} already exists. Use overwrite=True if you're serious.")
 
-        self.add('date', time.strftime(TIME_FORMAT), {'event': 'modified'})
+        opf = self._prepare_save()
+        in_place = path.exists() and path.samefile(self.file)
+        start = hook_timer()
+
+        if not (in_place and append and not repack and self._append_archive(opf, compresslevel)):
+            with ExitStack() as stack:
+                target = path
+
+                if in_place:  # Never truncate the archive that the unchanged files are copied from
+                    target = stack.enter_context(replace_file(path))
+
+                source = stack.enter_context(self._open_archive())
+                zip_file = stack.enter_context(ZipFile(target, 'w', ZIP_DEFLATED,
+                                                       compresslevel=compresslevel))
+
+                for _name in self._write_archive(source, zip_file, opf, repack, workers):
+                    pass
+
+        if start is not None:  # Once a temporary file has replaced `path`
+            emit_event('zip_write', start, self.file, path.stat().st_size)
+
+        if in_place:  # The archive matches the temporary directory again
+            self.replaced.clear()
+
+            if self.mapping:  # The old mapping doesn't include the changes
+                self._unmap()
+                self.mapping = map_epub(self.file)
+
+            for _full_path, name in self._added_files(set()):
+                self._record_extracted(name)
+
+        self.modified = False
+
+    def iter_bytes(self, chunk_size: int = COPY_BUFFER_SIZE, repack: bool = False,
+                   compresslevel: int = None, workers: int = None) -> Iterator[bytes]:
+        """Yields the book, with the modified metadata, as a new epub file in chunks of
+        `chunk_size` bytes (the last one may be smaller). Each member of the archive is yielded
+        as soon as it has been written, so nothing is written to disk and only about one member
+        is held in memory at a time. This is useful for sending a book over a network.
+        See `save` for the other arguments."""
+
+        workers = workers or (os.cpu_count() if repack else 1)
+        opf = self._prepare_save()
+        stream = ArchiveStream()
+        start = hook_timer()
+        size = 0
+
+        with self._open_archive() as source, \
+             ZipFile(stream, 'w', ZIP_DEFLATED, compresslevel=compresslevel) as zip_file:
+            for _name in self._write_archive(source, zip_file, opf, repack, workers):
+                for chunk in stream.chunks(chunk_size):
+                    size += len(chunk)
+                    yield chunk
+
+        for chunk in stream.chunks(chunk_size, final=True):  # The central directory
+            size += len(chunk)
+            yield chunk
+
+        # Includes the time the caller spent with each chunk
+        emit_event('zip_write', start, self.file, size)
+        self.modified = False
+
+    def to_bytes(self, repack: bool = False, compresslevel: int = None,
+                 workers: int = None) -> bytes:
+        """Returns the book, with the modified metadata, as the contents of a new epub file.
+        See `save` for the arguments."""
+
+        return b''.join(self.iter_bytes(COPY_BUFFER_SIZE, repack, compresslevel, workers))
+
+    def _prepare_save(self) -> bytes:
+        """Updates the modified date, tidies the tree and returns it as the contents of the OPF
+        file. Raises `EPubError` in the middle of a batch."""
+
+        if self._batch is not None:
+            raise EPubError("Books can't be saved in the middle of a batch.")
+
+        for date in self.get_all('date'):  # Don't add another one every time the book is saved
+            if strip_namespaces(date.attrib) == {'event': 'modified'}:
+                date.text = time.strftime(TIME_FORMAT)
+                break
+        else:
+            self.add('date', time.strftime(TIME_FORMAT), {'event': 'modified'})
+
+        start = hook_timer()
 
         try:  # Tidy the XML (added in Python 3.9)
             ET.indent(self.etree)
         except AttributeError:
             pass
 
-        self.etree.write(path, xml_declaration=True, encoding='utf-8', method='xml')
+        opf = serialize_opf(self.root)
+        emit_event('serialize', start, self.file, len(opf))
 
-        # Work around an old issue in ElementTree:
-        # ElementTree incorrectly refuses to write attributes without namespaces
-        # when default_namespace is used
-        # https://bugs.python.org/issue17088
-        # https://github.com/python/cpython/pull/11050
+        if not self.lazy:  # Keep the extracted copy in sync with the tree
+            with open(self.opf, mode='wb') as opf_file:
+                opf_file.write(opf)
 
-        with open(self.opf, mode='r', encoding='utf-8') as opf:
-            text = opf.read()
+        return opf
 
-        text = text.replace('ns0:', '')
-        text = text.replace(':ns0', ':opf')
-        text = text.replace('<package ', '<package xmlns=\"http://www.idpf.org/2007/opf\" ')
+    def _member_status(self, info: ZipInfo) -> str:
+        """Returns what `save` should do with an archive member: 'opf', 'copy' it unchanged,
+        'write' the file in the temporary directory, or 'drop' it."""
 
-        with open(self.opf, mode='w', encoding='utf-8') as opf:
-            opf.write(text)
+        name = info.filename
 
-        with ZipFile(path, 'w', ZIP_DEFLATED) as zip_file:
-            for root, _dirs, files in os.walk(self.tempdir.name):
-                for name in files:
-                    full_path = Path(root, name)
-                    zip_file.write(full_path, full_path.relative_to(self.tempdir.name))
+        if name == self.opf_name:
+            return 'opf'
 
-        self.modified = False
+        if info.is_dir():
+            return 'copy'
+
+        if not self.tempdir or not Path(self.tempdir.name, name).exists():
+            # Never extracted, so it can't have changed. Otherwise it was deleted from the
+            # temporary directory.
+            return 'copy' if self.lazy else 'drop'
+
+        return 'copy' if self._is_unchanged(name) else 'write'
+
+    def _added_files(self, names: Set[str]) -> Iterator[Tuple[Path, str]]:
+        """Yields the paths and archive names of files in the temporary directory that are not
+        in `names`, i.e. files that have been added to the book."""
+
+        if not self.tempdir:
+            return
+
+        for root, _dirs, files in os.walk(self.tempdir.name):
+            for name in files:
+                full_path = Path(root, name)
+                name = full_path.relative_to(self.tempdir.name).as_posix()
+
+                if name not in names:
+                    yield full_path, name
+
+    def _write_archive(self, source: ZipFile, zip_file: ZipFile, opf: bytes,
+                       repack: bool = False, workers: int = 1) -> Iterator[str]:
+        """Writes the book to `zip_file`, yielding the name of each member once it has been
+        written. `mimetype` must be the first file and must not be compressed:
+        http://idpf.org/epub/30/spec/epub30-ocf.html#sec-zip-container-mime
+
+        Unchanged members are copied as they are unless `repack` is True. Everything else is
+        compressed by `workers` threads, see `write_members`."""
+
+        # With the CRC and size known up front, ZipFile can't add a data descriptor to mimetype
+        # when `zip_file` can't seek, which readers that check the OCF rules would reject
+        info, data = compress_member(member_info('mimetype'), lambda: b'application/epub+zip',
+                                     None)
+        write_raw_member(zip_file, info, (data,))
+        yield 'mimetype'
+
+        yield from write_members(source, zip_file, self._archive_members(source, opf, repack),
+                                 workers)
+
+    def _archive_members(self, source: ZipFile, opf: bytes, repack: bool) -> Iterator[Member]:
+        """Yields every member of the book except `mimetype`, in the order they are written."""
+
+        written = {'mimetype'}
+
+        for info in source.infolist():
+            if info.filename in written:
+                continue
+
+            written.add(info.filename)
+
+            match self._member_status(info):
+                case 'opf':
+                    yield Member(member_info(info.filename), lambda: opf)
+                case 'copy' if repack and not info.is_dir():
+                    yield Member(member_info(info.filename, info), partial(source.read, info))
+                case 'copy':
+                    yield Member(info)
+                case 'write':
+                    path = Path(self.tempdir.name, info.filename)
+                    yield Member(member_info(info.filename, path), path.read_bytes)
+
+        for full_path, name in self._added_files(written):
+            yield Member(member_info(name, full_path), full_path.read_bytes)
+
+    def _append_archive(self, opf: bytes, compresslevel: int = None) -> bool:
+        """Replaces the changed members of the original archive in place. See `save`.
+        Returns False, without changing anything, if `mimetype` is not already the first,
+        uncompressed member. The whole archive has to be rewritten to fix that."""
+
+        with ZipFile(self.file, 'a', ZIP_DEFLATED, compresslevel=compresslevel) as zip_file:
+            first = zip_file.infolist()[0] if zip_file.infolist() else None
+
+            if not first or first.filename != 'mimetype' or first.compress_type != ZIP_STORED:
+                return False
+
+            for info in list(zip_file.infolist()):
+                match self._member_status(info):
+                    case 'opf':
+                        remove_member(zip_file, info.filename)
+                        zip_file.writestr(info.filename, opf, compress_type(info.filename))
+                    case 'write':
+                        remove_member(zip_file, info.filename)
+                        zip_file.write(Path(self.tempdir.name, info.filename), info.filename,
+                                       compress_type(info.filename))
+                    case 'drop':
+                        remove_member(zip_file, info.filename)
+
+            for full_path, name in self._added_files(set(zip_file.NameToInfo)):
+                zip_file.write(full_path, name, compress_type(name))
+
+        return True
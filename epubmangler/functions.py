@@ -4,15 +4,35 @@ from __future__ import annotations
 
 import os
 import json
+import mimetypes
+import mmap
 import re
 
 import xml.etree.ElementTree as ET
 
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
-from zipfile import ZipFile, is_zipfile, ZIP_DEFLATED
+from typing import Any, BinaryIO, Dict, List, Tuple
+from zipfile import BadZipFile, ZipFile, is_zipfile, ZIP_DEFLATED
 
+from .archive import LOCAL_HEADER, LOCAL_HEADER_SIGNATURE, MappedFile
 from .globals import ILLEGAL_CHARS, NAMESPACES
+from .hooks import emit_event, hook_timer
+
+
+class EPubError(Exception):
+    """Exception that is raised when an error occurs during an `EPub` method."""
+
+
+def element_to_dict(element: ET.Element) -> Dict[str, Any]:
+    """Returns a metadata element as a dictionary of plain Python data, without namespaces:
+
+    `{'tag': 'creator', 'text': 'Mary Wollstonecraft Shelley',
+    'attrib': {'file-as': 'Shelley, Mary Wollstonecraft'}}`"""
+
+    return {'tag': strip_namespace(element.tag),
+            'text': element.text if element.text else '',
+            'attrib': strip_namespaces(element.attrib)}
 
 
 def file_as(name: str) -> str:
@@ -34,14 +54,25 @@ def file_as(name: str) -> str:
     return f'{parts[len(parts) - 1]}, {name}'
 
 
-def find_opf_files(path: str | bytes | os.PathLike) -> List[str]:
+def find_opf_files(path: str | bytes | os.PathLike | ZipFile) -> List[str]:
     """Returns a list of all the OPF files as defined in: `META-INF/container.xml`
 
+    `path` is either the directory that an epub has been extracted to, or an open `ZipFile`.
+    In the second case nothing is extracted, and the archive member names are returned
+    instead of full paths.
+
     We only ever use the first one, and no books seem to have more than one, but
     the specification states that there could be."""
 
-    with open(Path(path, 'META-INF/container.xml'), mode='r', encoding='utf-8') as container:
-        xml_string = container.read()
+    start = hook_timer()
+
+    if isinstance(path, ZipFile):
+        xml_string = path.read('META-INF/container.xml').decode('utf-8')
+    else:
+        with open(Path(path, 'META-INF/container.xml'), mode='r', encoding='utf-8') as container:
+            xml_string = container.read()
+
+    size = len(xml_string)
 
     # Remove the default namespace definition (xmlns="http://some/namespace")
     # https://stackoverflow.com/questions/34009992/python-elementtree-default-namespace
@@ -51,25 +82,123 @@ def find_opf_files(path: str | bytes | os.PathLike) -> List[str]:
     files = []
 
     for item in root.findall('./rootfiles/rootfile'):
-        files.append(Path(path, item.attrib['full-path']))
+        if isinstance(path, ZipFile):
+            files.append(item.attrib['full-path'])
+        else:
+            files.append(Path(path, item.attrib['full-path']))
 
+    emit_event('find_opf_files', start, getattr(path, 'filename', path), size)
     return files
 
 
-def is_epub(path: str | bytes | os.PathLike) -> bool:
-    """Returns True if `path` points to a valid epub file."""
+# Enough of the start of a file for has_epub_header, even if the header has an extra field
+EPUB_HEADER_SIZE = 256
+
+
+def has_epub_header(data: bytes) -> bool:
+    """Returns True if `data`, the start of a file, is an uncompressed `mimetype` file that
+    contains `application/epub+zip`. The OCF specification requires every epub file to start
+    like this: http://idpf.org/epub/30/spec/epub30-ocf.html#sec-zip-container-mime"""
+
+    if len(data) < LOCAL_HEADER.size or data[:4] != LOCAL_HEADER_SIGNATURE:
+        return False
+
+    (_signature, _version, _system, _flags, method, _time, _date, _crc, _compressed_size,
+     _size, name_length, extra_length) = LOCAL_HEADER.unpack_from(data)
+    start = LOCAL_HEADER.size + name_length + extra_length
+
+    return (method == 0 and data[LOCAL_HEADER.size:LOCAL_HEADER.size + name_length] == b'mimetype'
+            and data[start:start + 20] == b'application/epub+zip')
+
+
+def is_epub(path: str | bytes | os.PathLike | ZipFile) -> bool:
+    """Returns True if `path` points to a valid epub file. `path` can also be an open `ZipFile`.
+
+    Usually only the first few bytes of the file are read (see `has_epub_header`). Files that
+    don't follow the specification are checked by looking for `mimetype` in the archive."""
+
+    start = hook_timer()
+    result = _is_epub(path)
+    emit_event('is_epub', start, getattr(path, 'filename', path), EPUB_HEADER_SIZE)
+    return result
+
 
-    file_path = Path(path).absolute()
+def _is_epub(path: str | bytes | os.PathLike | ZipFile) -> bool:
 
-    if not file_path.exists() or file_path.suffix != '.epub' or not is_zipfile(file_path):
+    if isinstance(path, ZipFile):
+        with path._lock:  # pylint: disable=protected-access
+            path.fp.seek(0)
+            header = path.fp.read(EPUB_HEADER_SIZE)
+
+        return has_epub_header(header) or has_epub_mimetype(path)
+
+    file_path = Path(path)
+
+    if file_path.suffix != '.epub':
+        return False
+
+    try:
+        with open(file_path, mode='rb') as file_handle:
+            if has_epub_header(file_handle.read(EPUB_HEADER_SIZE)):
+                return True
+    except OSError:
+        return False
+
+    if not is_zipfile(file_path):
         return False
 
     with ZipFile(path, 'r', ZIP_DEFLATED) as zip_file:
-        if 'mimetype' in zip_file.namelist():
-            with zip_file.open('mimetype') as file_handle:
-                return file_handle.read(20) == b'application/epub+zip'
-        else:
-            return False
+        return has_epub_mimetype(zip_file)
+
+
+def has_epub_mimetype(zip_file: ZipFile) -> bool:
+    """Returns True if `zip_file` contains a `mimetype` file that contains `application/epub+zip`
+    anywhere in the archive. See `is_epub`."""
+
+    if 'mimetype' in zip_file.namelist():
+        with zip_file.open('mimetype') as file_handle:
+            return file_handle.read(20) == b'application/epub+zip'
+    else:
+        return False
+
+
+def map_epub(path: str | bytes | os.PathLike) -> mmap.mmap:
+    """Memory maps the epub file at `path` read only, raising `EPubError` if it can't be. The
+    operating system shares the pages with every other process that maps or reads the file."""
+
+    if Path(path).suffix != '.epub':
+        raise EPubError(f"{path} is not a valid .epub file.")
+
+    try:
+        with open(path, mode='rb') as file_handle:
+            return mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as error:  # ValueError: the file is empty
+        raise EPubError(f"{path} is not a valid .epub file.") from error
+
+
+def open_epub(path: str | bytes | os.PathLike, mapping: mmap.mmap = None) -> ZipFile:
+    """Opens the epub file at `path` and returns it as a `ZipFile`, raising `EPubError` if it is
+    not valid. The same file handle is used to check and to read the file. If `mapping` is the
+    file memory mapped by `map_epub`, it is read from the mapping instead."""
+
+    if Path(path).suffix != '.epub':
+        raise EPubError(f"{path} is not a valid .epub file.")
+
+    start = hook_timer()
+
+    try:
+        zip_file = ZipFile(MappedFile(mapping) if mapping else path, 'r', ZIP_DEFLATED)
+    except (OSError, BadZipFile) as error:
+        raise EPubError(f"{path} is not a valid .epub file.") from error
+
+    if start is not None:
+        emit_event('zip_open', start, path, len(mapping) if mapping else os.path.getsize(path))
+
+    if not is_epub(zip_file):
+        zip_file.close()
+        raise EPubError(f"{path} is not a valid .epub file.")
+
+    return zip_file
 
 
 def json_to_dict(input_str: str) -> Dict[str, str]:
@@ -99,6 +228,196 @@ def new_element(name: str, text: str, attrib: Dict[str, str] = None) -> ET.Eleme
     return ET.Element(namespaced_text(f'dc:{name}'), text=text, attrib=attrib)
 
 
+# Matches the simple xpaths in XPATHS: './opf:metadata/dc:creator[@opf:role="aut"]'
+METADATA_XPATH = re.compile(r'^\./opf:metadata/(\w+:[\w-]+)/?(?:\[@([\w:-]+)="([^"]*)"\])?$')
+
+
+@lru_cache(maxsize=None)
+def xpath_key(xpath: str) -> Tuple[str, str | None, str | None] | None:
+    """Returns the tag, and the attribute name and value if there is one, that a simple xpath
+    into the metadata section matches. These are namespaced for elementtree.
+
+    `xpath_key('./opf:metadata/dc:date/[@opf:event="publication"]')` returns
+    `('{http://purl.org/dc/elements/1.1/}date', '{http://www.idpf.org/2007/opf}event',
+    'publication')`
+
+    Returns None if `xpath` is more complicated than that."""
+
+    match = METADATA_XPATH.match(xpath)
+
+    if not match:
+        return None
+
+    tag, attribute, value = match.groups()
+
+    return namespaced_text(tag), namespaced_text(attribute) if attribute else None, value
+
+
+READ_METADATA_CHUNK_SIZE = 4 * 1024
+
+
+def read_metadata(path: str | bytes | os.PathLike) -> List[Dict[str, Any]]:
+    """Returns the metadata of the epub file at `path` as a list of dictionaries, in the same
+    format as `element_to_dict`. This is much faster than opening an `EPub` if you only need to
+    read the metadata. The OPF file is read straight from the archive, and reading stops at the
+    end of the metadata section, so the manifest and spine are never parsed."""
+
+    metadata_tag = f"{{{NAMESPACES['opf']}}}metadata"
+    parser = ET.XMLPullParser(events=('end',))
+
+    with open_epub(path) as zip_file:
+        try:
+            source = zip_file.open(find_opf_files(zip_file)[0])
+        except (IndexError, KeyError, ET.ParseError, UnicodeDecodeError) as error:
+            # No container.xml or OPF found, or container.xml is malformed
+            raise EPubError(f"{path} is not a valid .epub file.") from error
+
+        with source:
+            try:
+                while chunk := source.read(READ_METADATA_CHUNK_SIZE):
+                    parser.feed(chunk)
+
+                    for _event, element in parser.read_events():
+                        if element.tag == metadata_tag:
+                            return [element_to_dict(item) for item in element]
+
+            except ET.ParseError as parse_error:  # XML error
+                raise EPubError(f"{path} is not a valid .epub file.") from parse_error
+
+    raise EPubError(f"{path} has no metadata section.")
+
+
+# The first bytes of each type of image in IMAGE_TYPES
+IMAGE_SIGNATURES = ((b'\xff\xd8\xff', 'image/jpeg'), (b'\x89PNG\r\n\x1a\n', 'image/png'),
+                    (b'GIF87a', 'image/gif'), (b'GIF89a', 'image/gif'))
+
+
+def image_type(data: bytes) -> str | None:
+    """Returns the MIME type of the image `data` from its first few bytes, or None if it isn't
+    one of the types in `IMAGE_TYPES`."""
+
+    for signature, mime in IMAGE_SIGNATURES:
+        if bytes(data[:len(signature)]) == signature:
+            return mime
+
+    return None
+
+
+def read_image(source: str | os.PathLike | bytes | BinaryIO) -> Tuple[Path | bytes, str | None]:
+    """Returns an image given as a path, as its contents or as a readable binary file object,
+    along with its MIME type. Paths are returned as a `Path` and are not read; the MIME type is
+    guessed from the name, and is None if the file doesn't exist. Everything else is returned as
+    the contents of the image, and the MIME type comes from the data itself."""
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source, image_type(source)
+
+    if hasattr(source, 'read'):
+        data = source.read()
+        return data, image_type(data)
+
+    path = Path(source)
+
+    return path, mimetypes.guess_type(path)[0] if path.exists() else None
+
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+ATTRIBUTE_ESCAPES = (('"', '&quot;'), ('\n', '&#10;'), ('\r', '&#13;'), ('\t', '&#09;'))
+
+
+def escape_xml(text: str, attribute: bool = False) -> str:
+    """Returns `text` with the characters that are not allowed in XML text, or in an attribute
+    value if `attribute` is True, replaced by entities. Most text has none of them, so that is
+    checked first."""
+
+    if '&' in text or '<' in text or '>' in text:
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    if attribute:
+        for character, entity in ATTRIBUTE_ESCAPES:
+            if character in text:
+                text = text.replace(character, entity)
+
+    return text
+
+
+def serialize_opf(root: ET.Element) -> bytes:
+    """Returns the OPF file with the root element `root` as UTF-8 encoded bytes.
+
+    ElementTree can't write the OPF namespace as the default namespace when there are
+    attributes without a namespace (https://bugs.python.org/issue17088), so this writes the
+    tree itself in a single pass. Elements in the OPF namespace have no prefix, attributes in it
+    use `opf:` and the other namespaces use their prefixes from `NAMESPACES`. Attribute names
+    with a literal prefix, like `opf:scheme`, are written as they are. Every namespace that is
+    used is declared on the root element."""
+
+    prefixes = {uri: prefix for prefix, uri in NAMESPACES.items() if prefix}
+    prefixes[NAMESPACES['opf']] = 'opf'
+    prefixes[XML_NAMESPACE] = 'xml'
+    used = {'opf'}
+    output = ['<?xml version="1.0" encoding="utf-8"?>\n']
+
+    def qualified_name(name: str, attribute: bool) -> str:
+        if name[0] == '{':
+            uri, name = name[1:].split('}', 1)
+
+            if uri == NAMESPACES['opf'] and not attribute:
+                return name
+
+            if uri not in prefixes:
+                prefixes[uri] = f'ns{len(prefixes)}'
+
+            used.add(prefixes[uri])
+            return f'{prefixes[uri]}:{name}'
+
+        if attribute and ':' in name:  # A literal prefix
+            used.add(name.split(':', 1)[0])
+
+        return name
+
+    def write(element: ET.Element) -> None:
+        if element.tag is ET.Comment:
+            output.append(f'<!--{element.text}-->')
+        elif element.tag is ET.ProcessingInstruction:
+            output.append(f'<?{element.text}?>')
+        else:
+            tag = qualified_name(element.tag, False)
+            output.append(f'<{tag}')
+
+            if element is root:
+                declarations = len(output)
+                output.append('')  # Filled in once every namespace has been seen
+
+            for key, value in element.attrib.items():
+                output.append(f' {qualified_name(key, True)}="{escape_xml(value, True)}"')
+
+            if element.text or len(element):
+                output.append('>')
+
+                if element.text:
+                    output.append(escape_xml(element.text))
+
+                for child in element:
+                    write(child)
+
+                output.append(f'</{tag}>')
+            else:
+                output.append(' />')
+
+            if element is root:
+                uris = {prefix: uri for uri, prefix in prefixes.items()}
+                output[declarations] = ''.join(
+                    [f' xmlns="{NAMESPACES["opf"]}"'] +
+                    [f' xmlns:{prefix}="{uris[prefix]}"' for prefix in sorted(used)
+                     if prefix != 'xml' and prefix in uris])
+
+        if element.tail:
+            output.append(escape_xml(element.tail))
+
+    write(root)
+    return ''.join(output).encode('utf-8')
+
+
 def sizeof_format(file: str) -> str:
     """Returns a human readable, decimal prefixed string containing the file size of `number`."""
 
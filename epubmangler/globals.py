@@ -28,11 +28,11 @@ XPATHS = {
     'identifier'    :   ['./opf:metadata/dc:identifier'],
     'isbn'          :   ['./opf:metadata/dc:identifier/[@opf:scheme="isbn"]',
                          './opf:metadata/dc:identifier/[@opf:scheme="ISBN"]'],
-    'doi'           :   ['./opf:metadata/dc:identifier/[@opf:scheme="doi"]'
+    'doi'           :   ['./opf:metadata/dc:identifier/[@opf:scheme="doi"]',
                          './opf:metadata/dc:identifier/[@opf:scheme="DOI"]'],
-    'uuid'          :   ['./opf:metadata/dc:identifier/[@opf:scheme="uuid"]'
+    'uuid'          :   ['./opf:metadata/dc:identifier/[@opf:scheme="uuid"]',
                          './opf:metadata/dc:identifier/[@opf:scheme="UUID"]'],
-    'uri'           :   ['./opf:metadata/dc:identifier/[@opf:scheme="uri"]'
+    'uri'           :   ['./opf:metadata/dc:identifier/[@opf:scheme="uri"]',
                          './opf:metadata/dc:identifier/[@opf:scheme="URI"]'],
 
     'cover'         :   ['./opf:metadata/opf:meta/[@name="cover"]'],
@@ -52,6 +52,12 @@ NAMESPACES = {
 # Only these types are valid as cover images
 IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif')
 
+# Files of these types are already compressed, so they are stored in the archive as they are.
+# Deflating them again wastes time for almost no gain. TrueType and OpenType fonts are not
+# compressed, so they are still deflated.
+STORED_TYPES = IMAGE_TYPES + ('image/webp', 'font/woff', 'font/woff2',
+                              'audio/mpeg', 'audio/mp4', 'video/mp4')
+
 # Characters that may cause file system errors if used in filenames
 ILLEGAL_CHARS = ('/', '\\', ':', '*', '?', '\"', '<', '>', '|')
 
@@ -0,0 +1,94 @@
+"""Hooks that are told how long each stage of opening, checking and saving a book takes, so the
+timings can be passed on to a tracing or metrics system without changing epubmangler:
+
+`def log_event(event):`
+    `print(f'{event.name} {event.file}: {event.duration:.6f}s {event.size} bytes')`
+
+`epubmangler.add_hook(log_event)`
+
+Hooks are called with an `Event`, in the thread that did the work, as soon as each stage
+ends. Stages can contain others, for instance `parse_opf` contains `find_opf_files`. These are
+the stages, and what `size` counts for each of them:
+
+`zip_open`: an archive is opened and its central directory read, the size of the archive
+`is_epub`: a file is checked to be an epub file, the bytes read from its header
+`extract`: files are extracted to the temporary directory, their uncompressed size
+`find_opf_files`: `META-INF/container.xml` is read, its size
+`parse_opf`: the OPF file is parsed and indexed, its uncompressed size
+`serialize`: the tree is written out as the contents of the OPF file, its size
+`zip_write`: a new archive is written, its size, or 0 if it can't be told
+
+Since `serialize_opf`, the namespace prefixes are written while the tree is serialized, so
+there is no separate stage for fixing them up.
+
+When no hooks are registered, each stage costs a check that the list of hooks is empty."""
+
+from __future__ import annotations
+
+import os
+import time
+
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, NamedTuple
+
+
+class Event(NamedTuple):
+    """A stage of work on the book at `file`, which took `duration` seconds and read or wrote
+    `size` bytes. See the list of stages above."""
+
+    name: str
+    file: str
+    duration: float
+    size: int
+
+
+# The registered hooks, in the order they are called
+HOOKS: List[Callable[[Event], Any]] = []
+
+
+def add_hook(hook: Callable[[Event], Any]) -> None:
+    """Calls `hook` with an `Event` at the end of every stage. Exceptions raised by a hook are
+    not caught, so it should be quick and shouldn't fail."""
+
+    HOOKS.append(hook)
+
+
+def remove_hook(hook: Callable[[Event], Any]) -> None:
+    """Stops calling `hook`. Raises `ValueError` if it wasn't added."""
+
+    HOOKS.remove(hook)
+
+
+@contextmanager
+def hooked(hook: Callable[[Event], Any]) -> Iterator[Callable[[Event], Any]]:
+    """Calls `hook` at the end of every stage inside the block:
+
+    `with hooked(events.append):`
+        `EPub('Frankenstein.epub')`"""
+
+    add_hook(hook)
+
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+
+def hook_timer() -> float | None:
+    """Returns the time a stage starts, to pass to `emit_event` when it ends, or None if there
+    are no hooks, so nothing is measured."""
+
+    return time.perf_counter() if HOOKS else None
+
+
+def emit_event(name: str, start: float | None, file: Any, size: int = 0) -> None:
+    """Calls every hook with the stage `name` that began at `start`, from `hook_timer`. Does
+    nothing if `start` is None. `file` is the book the work was done on."""
+
+    if start is None:
+        return
+
+    event = Event(name, os.fsdecode(file) if file else '', time.perf_counter() - start, size)
+
+    for hook in tuple(HOOKS):  # Hooks can remove themselves
+        hook(event)
@@ -0,0 +1,142 @@
+"""Functions that work on whole directories of epub files."""
+
+from __future__ import annotations
+
+import os
+
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, NamedTuple, Sequence
+
+from .epub import EPub
+from .functions import element_to_dict, is_epub, read_metadata
+
+if TYPE_CHECKING:
+    from .cache import MetadataCache
+
+
+class ScanResult(NamedTuple):
+    """The metadata of one file found by `scan`, in the format returned by `read_metadata`.
+    If the file could not be read, `metadata` is None and `error` is the exception.
+
+    `cover` and `version` are only filled in when `scan` is given a cache. See `read_book`."""
+
+    path: str
+    metadata: List[Dict[str, Any]] | None
+    error: Exception | None
+    cover: str | None = None
+    version: str | None = None
+
+
+def read_book(path: str | bytes | os.PathLike) -> Dict[str, Any]:
+    """Returns the metadata, the name of the cover image in the archive and the EPub version of
+    the epub file at `path`, as stored by `MetadataCache`. Unlike `read_metadata`, this parses
+    the whole OPF file, but nothing else is extracted."""
+
+    with EPub(path, lazy=True) as book:
+        return {'metadata': [element_to_dict(element) for element in book.metadata],
+                'cover': book.get_cover_name(), 'version': book.version}
+
+
+def find_epubs(root: str | bytes | os.PathLike, recursive: bool = True) -> Iterator[str]:
+    """Yields the path of every epub file in `root`, and in its subdirectories if `recursive`
+    is True."""
+
+    directories = [root]
+
+    while directories:
+        try:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            directories.append(entry.path)
+                    elif entry.is_file() and is_epub(entry.path):
+                        yield entry.path
+        except OSError:  # Unreadable directory
+            continue
+
+
+def read_files(paths: Sequence[str], details: bool = False) -> List[ScanResult]:
+    """Reads the metadata of each file in `paths`, and the cover and version too if `details`
+    is True. Errors are returned rather than raised."""
+
+    results = []
+
+    for path in paths:
+        try:
+            if details:
+                book = read_book(path)
+                results.append(ScanResult(path, book['metadata'], None,
+                                          book['cover'], book['version']))
+            else:
+                results.append(ScanResult(path, read_metadata(path), None))
+        except Exception as error:  # pylint: disable=broad-except
+            results.append(ScanResult(path, None, error))
+
+    return results
+
+
+def scan(root: str | bytes | os.PathLike, workers: int = None, chunk_size: int = 16,
+         cache: MetadataCache = None, recursive: bool = True) -> Iterator[ScanResult]:
+    """Yields a `ScanResult` for every epub file in `root`, and in its subdirectories unless
+    `recursive` is False.
+
+    The files are read by `workers` processes, which defaults to the number of CPUs, in groups
+    of `chunk_size`. Results are yielded as soon as they are ready, so they are not in any
+    particular order. Only a few groups are queued at a time, so huge directories are fine.
+
+    If a `MetadataCache` is given, files that haven't changed since they were cached are not
+    opened at all, and the cache is updated with everything else."""
+
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(workers)  # pylint: disable=consider-using-with
+    pending: Dict[Future, List[str]] = {}
+
+    def results(futures: Sequence[Future]) -> Iterator[ScanResult]:
+        for future in futures:
+            paths = pending.pop(future)
+
+            try:
+                chunk_results = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                # The worker process died, so blame every file in the group
+                chunk_results = [ScanResult(path, None, error) for path in paths]
+
+            for result in chunk_results:
+                if cache is not None and not result.error:
+                    try:
+                        cache.put(result.path, result.metadata, result.cover, result.version)
+                    except OSError as error:  # The file was removed or replaced since
+                        result = ScanResult(result.path, None, error)
+
+                yield result
+
+    try:
+        chunk = []
+
+        for path in find_epubs(root, recursive):
+            if cache is not None and (cached := cache.get(path)):
+                yield ScanResult(path, cached['metadata'], None, cached['cover'],
+                                 cached['version'])
+                continue
+
+            chunk.append(path)
+
+            if len(chunk) == chunk_size:
+                pending[executor.submit(read_files, chunk, cache is not None)] = chunk
+                chunk = []
+
+            if len(pending) >= workers * 2:
+                done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+                yield from results(done)
+
+        if chunk:
+            pending[executor.submit(read_files, chunk, cache is not None)] = chunk
+
+        while pending:
+            done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+            yield from results(done)
+
+    finally:
+        executor.shutdown(cancel_futures=True)
+
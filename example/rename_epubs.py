@@ -3,25 +3,33 @@
 
 import os
 import sys
-import timeit
+import time
 
 from pathlib import Path
-from epubmangler import EPub, EPubError, is_epub, ILLEGAL_CHARS
+from epubmangler import ILLEGAL_CHARS, ScanResult, scan
 
 
-def rename_file(in_file: str | bytes | os.PathLike) -> None:
+def rename_file(result: ScanResult) -> None:
     """Rename file to its EPub metadata or return."""
 
-    try:
-        book = EPub(in_file)
-    except EPubError:
+    if result.error:
+        print(f'Could not read {result.path}: {result.error}')
         return
 
+    fields = {}
+
+    for item in result.metadata:
+        fields.setdefault(item['tag'], item['text'])
+
+        # Prefer the author to editors and illustrators, as EPub.get('creator') does
+        if item['tag'] == 'creator' and item['attrib'].get('role') == 'aut':
+            fields.setdefault('author', item['text'])
+
     try:
-        title = book.get('title').text
-        author = book.get('creator').text
-    except NameError:
-        print(f'No title or author metadata: {in_file}')
+        title = fields['title']
+        author = fields.get('author', fields['creator'])
+    except KeyError:
+        print(f'No title or author metadata: {result.path}')
         return
 
     file_name = f'{author} - {title}.epub'
@@ -30,7 +38,8 @@ def rename_file(in_file: str | bytes | os.PathLike) -> None:
     for char in ILLEGAL_CHARS:
         file_name = file_name.replace(char, '-')
 
-    new_file = Path(file_name)
+    in_file = Path(result.path)
+    new_file = in_file.with_name(file_name)
 
     if new_file != in_file:
         os.rename(in_file, new_file)
@@ -44,13 +53,11 @@ if __name__ == '__main__':
         DIR = os.getcwd()
 
     FILES = 0
-    TIME = 0
+    START = time.perf_counter()
 
-    for file in os.listdir(DIR):
-        if is_epub(Path(DIR, file)):
-            FILES += 1
-            TIME += timeit.timeit(stmt='rename_file(path)',
-                                  setup='from __main__ import rename_file, path',
-                                  number=1)
+    # Read the whole directory in parallel first, so that renamed files aren't found twice
+    for book in list(scan(DIR, recursive=False)):
+        FILES += 1
+        rename_file(book)
 
-    print(f'Read {FILES} files in {round(TIME, 3)}s')
+    print(f'Read {FILES} files in {round(time.perf_counter() - START, 3)}s')
@@ -7,7 +7,7 @@ from pathlib import Path
 from xml.etree.ElementTree import Element
 
 from epubmangler import (EPub, EPubError, sizeof_format, strip_namespace, strip_namespaces,
-                         IMAGE_TYPES, NAMESPACES, VERSION, TIME_FORMAT, WEBSITE, XPATHS)
+                         IMAGE_TYPES, VERSION, TIME_FORMAT, WEBSITE, XPATHS)
 
 import gi
 gi.require_version('Gdk', '3.0')
@@ -150,17 +150,19 @@ class Application:
     # METHODS :
 
 
-    def set_cover_image(self, path: str = None) -> None:
-        if not path:
-            path = self.book.get_cover()
+    def set_cover_image(self) -> None:
+        # Read straight from the book, so the cover is never extracted or copied
+        data = self.book.get_cover_bytes()
 
-        def scale_cover(file: str, rect: Gdk.Rectangle) -> GdkPixbuf.Pixbuf:
-            return GdkPixbuf.Pixbuf.new_from_file_at_size(file, (rect.width * 0.3),
-                                                          (rect.height * 0.9))
+        def scale_cover(data: bytes, rect: Gdk.Rectangle) -> GdkPixbuf.Pixbuf:
+            stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+            return GdkPixbuf.Pixbuf.new_from_stream_at_scale(stream, int(rect.width * 0.3),
+                                                             int(rect.height * 0.9), True, None)
 
-        if path and Path(path).exists():
+        if data:
+            data = bytes(data)
             self.window.connect('size-allocate', lambda _win, allocation:
-                                self.get('cover').set_from_pixbuf(scale_cover(path, allocation)))
+                                self.get('cover').set_from_pixbuf(scale_cover(data, allocation)))
         else:
             self.get('cover').set_from_icon_name('image-missing', Gtk.IconSize.DIALOG)
 
@@ -323,7 +325,7 @@ class Application:
             element.text = self.get('text_entry').get_text()
             element.attrib = attrib
 
-            self.book.etree.find('./opf:metadata', NAMESPACES).append(element)
+            self.book.extend([element])
             self.details.append([self.get('tag_entry').get_text(),
                                 self.get('text_entry').get_text(),
                                 self.get('attrib_entry').get_text()])
@@ -376,7 +378,7 @@ class Application:
             else:
                 self.book.add_cover(filename)
 
-            self.set_cover_image(filename)
+            self.set_cover_image()
 
         dialog.destroy()
 
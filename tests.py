@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 """Test all EPub methods against a random book from Project Gutenberg."""
 
+import asyncio
+import io
 import os
+import pickle
 import unittest
 import random
+import shutil
+import tempfile
+import time
+import zipfile
 
 from pathlib import Path
 
@@ -11,11 +18,15 @@ import xml.etree.ElementTree as ET
 
 import epubmangler
 
-# Select a book from local selection of epubs
-DIR = '/home/david/Projects/epubmangler/books/gutenberg'
+# Select a book from local selection of epubs, or use the example book if there isn't one
+DIR = os.environ.get('EPUBMANGLER_BOOKS', '/home/david/Projects/epubmangler/books/gutenberg')
 # DIR = '/home/david/Projects/epubmangler/books/calibre'
-BOOKS = os.listdir(DIR)
-BOOK = Path(DIR, random.choice(BOOKS))
+
+if Path(DIR).is_dir():
+    BOOK = Path(DIR, random.choice(os.listdir(DIR)))
+else:
+    BOOK = Path('example/Frankenstein.epub')
+
 FILENAME = 'testtesttest.epub'
 
 # pylint: skip-file
@@ -39,20 +50,158 @@ class EPub2GutenbergTestCase(unittest.TestCase):
         for item in self.book.get_all('date'):
             self.assertIsInstance(item, ET.Element)
 
+    def test_has_element(self):
+        self.assertTrue(self.book.has_element('title'))
+        self.book.remove('title')
+        self.assertFalse(self.book.has_element('title'))
+        self.assertRaises(epubmangler.epub.EPubError, self.book.has_element, 'nothing')
+
+    def test_index(self):
+        self.book.add_subject('zzz')
+        self.book.set('creator', 'someone', {'ddd': 'zzz'})
+        self.book.set_identifier('1234567890', 'isbn')
+
+        for name, xpaths in epubmangler.XPATHS.items():
+            found = [element for xpath in xpaths
+                     for element in self.book.root.findall(xpath, epubmangler.NAMESPACES)]
+            self.assertEqual(found, self.book.get_all(name))
+
     def test_get_cover(self):
         self.assertTrue(Path(self.book.get_cover()).exists())
 
+    def test_get_cover_bytes(self):
+        with epubmangler.EPub(BOOK, lazy=True) as book:
+            data = book.get_cover_bytes()
+            self.assertIsInstance(data, memoryview)
+            self.assertIsNone(book.tempdir)
+
+            with book.open_cover() as cover:
+                self.assertEqual(cover.read(), data)
+
+        self.assertEqual(Path(self.book.get_cover()).read_bytes(), data)
+
+        picture = Path('example/cat_picture.jpg').read_bytes()
+        self.book.set_cover(picture)
+        self.assertEqual(self.book.get_cover_bytes(), picture)
+
+        with open('example/cat_picture.jpg', 'rb') as picture_file:
+            self.book.set_cover(picture_file)
+
+        self.assertEqual(self.book.get_cover_bytes(), picture)
+
     def test_save(self):
         self.book.save(FILENAME)
         self.assertTrue(Path(FILENAME).exists())
+
+        with zipfile.ZipFile(FILENAME) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.infolist()[0].filename, 'mimetype')
+            self.assertEqual(zip_file.infolist()[0].compress_type, zipfile.ZIP_STORED)
+
         self.assertRaises(FileExistsError, self.book.save, FILENAME)
         os.remove(FILENAME)
 
+    def test_save_in_place(self):
+        shutil.copy(BOOK, FILENAME)
+        size = Path(FILENAME).stat().st_size
+
+        with epubmangler.EPub(FILENAME, lazy=True) as book:
+            book.set('title', 'something')
+            book.save(FILENAME, overwrite=True)
+            book.save(FILENAME, overwrite=True)
+
+        with zipfile.ZipFile(FILENAME) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(len(zip_file.namelist()), len(set(zip_file.namelist())))
+
+        self.assertGreater(Path(FILENAME).stat().st_size, size)
+        epubmangler.compact(FILENAME)
+
+        with epubmangler.EPub(FILENAME) as book:
+            self.assertEqual(book.get('title').text, 'something')
+
+    def test_repack(self):
+        self.book.save(FILENAME, repack=True, compresslevel=1, workers=2)
+
+        with zipfile.ZipFile(FILENAME) as zip_file, zipfile.ZipFile(BOOK) as original:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.infolist()[0].filename, 'mimetype')
+            self.assertEqual(zip_file.getinfo(self.book.get_cover_name()).compress_type,
+                             zipfile.ZIP_STORED)
+
+            for name in original.namelist():
+                if name != self.book.opf_name:
+                    self.assertEqual(zip_file.read(name), original.read(name))
+
+        epubmangler.repack(FILENAME, compresslevel=9)
+
+        with zipfile.ZipFile(FILENAME) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertTrue(epubmangler.is_epub(zip_file))
+
+    def test_save_file_object(self):
+        self.book.set('title', 'something')
+        buffer = io.BytesIO()
+        self.book.save(buffer)
+        chunks = list(self.book.iter_bytes(4096))
+
+        self.assertTrue(all(len(chunk) == 4096 for chunk in chunks[:-1]))
+
+        for data in (buffer.getvalue(), b''.join(chunks), self.book.to_bytes()):
+            self.assertTrue(epubmangler.has_epub_header(data))
+
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+                self.assertIsNone(zip_file.testzip())
+                first = zip_file.infolist()[0]
+                self.assertEqual(first.filename, 'mimetype')
+                self.assertEqual(first.flag_bits & 0x08, 0)  # No data descriptor
+
+        Path(FILENAME).write_bytes(self.book.to_bytes())
+
+        with epubmangler.EPub(FILENAME, lazy=True) as book:
+            self.assertEqual(book.get('title').text, 'something')
+
     def test_add(self):
         els = self.book.get_all('date')
         for el in els:
             self.book.add(el.tag, 'ddd', el.attrib)
 
+    def test_is_epub(self):
+        self.assertTrue(epubmangler.is_epub(BOOK))
+        self.assertFalse(epubmangler.is_epub('example/cat_picture.jpg'))
+        self.assertFalse(epubmangler.is_epub('notafile.epub'))
+
+        with zipfile.ZipFile(BOOK) as zip_file:
+            self.assertTrue(epubmangler.is_epub(zip_file))
+
+        with open(BOOK, 'rb') as book:
+            self.assertTrue(epubmangler.has_epub_header(book.read(epubmangler.EPUB_HEADER_SIZE)))
+
+    def test_read_metadata(self):
+        self.assertEqual(epubmangler.read_metadata(BOOK),
+                         [epubmangler.element_to_dict(element) for element in self.book.metadata])
+        self.assertRaises(epubmangler.EPubError, epubmangler.read_metadata, 'notafile')
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copy(BOOK, Path(directory, 'book.epub'))
+            Path(directory, 'notabook.epub').write_bytes(b'nothing')
+            results = list(epubmangler.scan(directory, workers=2))
+
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[0].metadata, epubmangler.read_metadata(BOOK))
+
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copy(BOOK, Path(directory, 'book.epub'))
+            Path(directory, 'sub').mkdir()
+            shutil.copy(BOOK, Path(directory, 'sub', 'book.epub'))
+            self.assertEqual(len(list(epubmangler.scan(directory, workers=1))), 2)
+            results = list(epubmangler.scan(directory, workers=1, recursive=False))
+
+        self.assertEqual([Path(result.path).parent.name for result in results],
+                         [Path(directory).name])
+
     def test_set(self):
         self.book.set('title', 'something')
         self.assertEqual('something', self.book.get('title').text)
@@ -69,6 +218,19 @@ class EPub2GutenbergTestCase(unittest.TestCase):
     def test_set_cover(self):
         self.book.set_cover('example/cat_picture.jpg')
 
+    def test_serialize_opf(self):
+        self.book.set('language', 'en', {'xsi:type': 'dcterms:RFC4646'})
+        self.book.add_subject('Monsters & "Horror"')
+        opf = epubmangler.serialize_opf(self.book.root).decode('utf-8')
+
+        self.assertNotIn('ns0', opf)
+        self.assertIn('<package xmlns="http://www.idpf.org/2007/opf"', opf)
+        root = ET.fromstring(opf)
+        self.assertEqual(ET.tostring(root, encoding='unicode').count('<'),
+                         ET.tostring(self.book.root, encoding='unicode').count('<'))
+        self.assertEqual(root.findall('./opf:metadata/dc:subject', epubmangler.NAMESPACES)[-1].text,
+                         'Monsters & "Horror"')
+
     def test_set_identifier(self):
         self.book.set_identifier('1234567890', 'isbn')
         self.assertEqual(self.book.get('identifier').text, '1234567890')
@@ -87,6 +249,25 @@ class EPub2GutenbergTestCase(unittest.TestCase):
         len3 = len(self.book.get_all('subject'))
         self.assertLess(len3, len2)
 
+    def test_batch(self):
+        with self.book.batch():
+            self.book.set('title', 'something')
+            self.book.add_subject('zzz')
+            self.assertFalse(self.book.modified)
+
+        self.assertTrue(self.book.modified)
+        self.assertEqual(self.book.get('title').text, 'something')
+
+        metadata = repr(self.book)
+
+        with self.assertRaises(epubmangler.epub.EPubError):
+            with self.book.batch():
+                self.book.set('title', 'nothing')
+                self.book.add('publisher', 'aaa')
+                self.book.add('publisher', 'bbb')
+
+        self.assertEqual(repr(self.book), metadata)
+
     def test_setitem(self):
         self.book['title'] = 'zzzz'
         self.assertEqual(self.book.get('title').text, 'zzzz')
@@ -100,12 +281,205 @@ class EPub2GutenbergTestCase(unittest.TestCase):
         except epubmangler.epub.EPubError:
             pass
 
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            book = Path(directory, 'book.epub')
+            shutil.copy(BOOK, book)
+
+            with epubmangler.MetadataCache(Path(directory, 'cache.db')) as cache:
+                self.assertIsNone(cache.get(book))
+                entry = cache.load(book)
+                self.assertEqual(entry['version'], self.book.version)
+                self.assertEqual(entry['cover'], self.book.get_cover_name())
+                changes = cache.connection.total_changes
+                self.assertEqual(cache.get(book), entry)
+                self.assertEqual(cache.connection.total_changes, changes)  # Hits are read only
+                cache.flush()
+                self.assertEqual(cache.connection.total_changes, changes + 1)
+
+                os.utime(book, ns=(0, 0))
+                self.assertIsNone(cache.get(book))
+
+    def test_scan_removed(self):
+        class RemovingCache(epubmangler.MetadataCache):
+            def put(self, path, *args):
+                os.remove(path)  # As if the file was deleted while it was being read
+                super().put(path, *args)
+
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copy(BOOK, Path(directory, 'book.epub'))
+
+            with RemovingCache(Path(directory, 'cache.db')) as cache:
+                results = list(epubmangler.scan(directory, workers=1, cache=cache))
+                self.assertEqual(len(cache), 0)
+
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0].metadata)
+        self.assertIsInstance(results[0].error, FileNotFoundError)
+
     def test_context_handler(self):
         with epubmangler.EPub(BOOK) as _book:
             pass
 
+    def test_lazy(self):
+        with epubmangler.EPub(BOOK, lazy=True) as book:
+            self.assertIsNone(book.tempdir)
+            self.assertEqual(book.get('title').text, self.book.get('title').text)
+            self.assertTrue(Path(book.get_cover()).exists())
+            book.set('title', 'something')
+            book.save(FILENAME)
+            self.assertTrue(book.lazy)
+
+        with epubmangler.EPub(FILENAME, lazy=True) as book:
+            self.assertEqual(book.get('title').text, 'something')
+
+    def test_create_epub(self):
+        for version in ('2.0', '3.0'):
+            epubmangler.create_epub(FILENAME, version, title='Something', chapters=3,
+                                    subjects=2, cover_size=1000)
+            self.assertTrue(epubmangler.is_epub(FILENAME))
+
+            with epubmangler.EPub(FILENAME, lazy=True) as book:
+                self.assertEqual(book.version, version)
+                self.assertEqual(book.get('title').text, 'Something')
+                self.assertEqual(len(book.get_all('subject')), 2)
+                self.assertTrue(Path(book.get_cover()).exists())
+
+            os.remove(FILENAME)
+
+        self.assertRaises(ValueError, epubmangler.create_epub, FILENAME, '1.0')
+
+        epubmangler.create_epub(FILENAME, chapters=2, members=20, member_size=500)
+
+        with zipfile.ZipFile(FILENAME) as zip_file:
+            extra = [info for info in zip_file.infolist()
+                     if info.filename.startswith('OEBPS/extra/')]
+            self.assertEqual(len(extra), 20)
+            self.assertTrue(all(info.file_size >= 500 for info in extra))
+            opf = zip_file.read('OEBPS/content.opf').decode()
+            self.assertEqual(opf.count('<itemref'), 2)
+            self.assertNotIn('extra/', opf)
+
+    def test_mapped(self):
+        with epubmangler.EPub(BOOK, lazy=True, mapped=True) as book:
+            self.assertEqual(book.get('title').text, self.book.get('title').text)
+            self.assertEqual(book.get_cover_bytes(), Path(self.book.get_cover()).read_bytes())
+            book.set('title', 'something')
+            book.save(FILENAME)
+
+        with epubmangler.EPub(FILENAME, mapped=True) as book:
+            self.assertEqual(book.get('title').text, 'something')
+
+        for compression in (zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+            with zipfile.ZipFile(BOOK) as source, zipfile.ZipFile(FILENAME, 'w') as target:
+                for info in source.infolist():
+                    target.writestr(info.filename, source.read(info),
+                                    zipfile.ZIP_STORED if info.filename == 'mimetype'
+                                    else compression)
+
+            with epubmangler.EPub(FILENAME, lazy=True, mapped=True) as book:
+                self.assertEqual(book.get('title').text, self.book.get('title').text)
+                self.assertEqual(book.get_cover_bytes(),
+                                 Path(self.book.get_cover()).read_bytes())
+
+    def test_async(self):
+        async def edit():
+            runner = epubmangler.AsyncRunner(concurrency=2)
+
+            async with await epubmangler.AsyncEPub.open(BOOK, lazy=True, runner=runner) as book:
+                self.assertEqual(bytes(await book.get_cover_bytes()),
+                                 Path(self.book.get_cover()).read_bytes())
+                book['title'] = 'something'
+                self.assertEqual(book['title'].text, 'something')
+                await book.save(FILENAME)
+                data = b''.join([chunk async for chunk in book.iter_bytes(4096)])
+
+            return data, await epubmangler.AsyncEPub.read_metadata(FILENAME, runner)
+
+        data, metadata = asyncio.run(edit())
+        self.assertIn({'tag': 'title', 'text': 'something', 'attrib': {}}, metadata)
+
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+
+    def test_runner_full(self):
+        async def run():
+            runner = epubmangler.AsyncRunner(concurrency=1, max_waiting=1)
+            tasks = [asyncio.create_task(runner.run(time.sleep, 0.1)) for _ in range(2)]
+            await asyncio.sleep(0.01)  # Let one run and one wait
+
+            with self.assertRaises(epubmangler.RunnerFull):
+                await runner.run(time.sleep, 0)
+
+            await asyncio.gather(*tasks)
+            await runner.run(time.sleep, 0)
+
+        asyncio.run(run())
+
+    def test_pickle(self):
+        for lazy, mapped in ((False, False), (True, True)):
+            with epubmangler.EPub(BOOK, lazy=lazy, mapped=mapped) as book:
+                book.set('title', 'something')
+                copy = pickle.loads(pickle.dumps(book))
+                self.assertEqual(copy.get('title').text, 'something')
+                self.assertEqual(bool(copy.mapping), mapped)
+                copy.save(FILENAME)
+                del copy
+
+                if book.tempdir:  # The copy doesn't remove the original's files
+                    self.assertTrue(Path(book.tempdir.name).exists())
+
+            with epubmangler.EPub(FILENAME, lazy=True) as book:
+                self.assertEqual(book.get('title').text, 'something')
+
+            os.remove(FILENAME)
+
+    def test_hooks(self):
+        events = []
+
+        with epubmangler.hooked(events.append):
+            with epubmangler.EPub(BOOK) as book:
+                book.set('title', 'something')
+                book.save(FILENAME)
+
+        names = {event.name for event in events}
+        self.assertEqual(names, {'zip_open', 'is_epub', 'extract', 'find_opf_files', 'parse_opf',
+                                 'serialize', 'zip_write'})
+
+        for event in events:
+            self.assertGreaterEqual(event.duration, 0)
+
+        write = next(event for event in events if event.name == 'zip_write')
+        self.assertEqual(write.size, Path(FILENAME).stat().st_size)
+        self.assertFalse(epubmangler.HOOKS)
+
+        count = len(events)
+        epubmangler.EPub(FILENAME, lazy=True)
+        self.assertEqual(len(events), count)
+
+        # Saved in place, through a temporary file that replaces the original
+        events = []
+
+        with epubmangler.hooked(events.append):
+            with epubmangler.EPub(FILENAME, lazy=True) as book:
+                book.set('title', 'something else')
+                book.save(FILENAME, overwrite=True, append=False)
+
+        write = next(event for event in events if event.name == 'zip_write')
+        self.assertEqual(write.size, Path(FILENAME).stat().st_size)
+
     def test_init(self):
         self.assertRaises(epubmangler.epub.EPubError, epubmangler.EPub, 'notafile')
+
+        for container in (b'<container><rootfiles>', b'\xff\xfe<container/>'):
+            with zipfile.ZipFile(BOOK) as source, zipfile.ZipFile(FILENAME, 'w') as target:
+                for info in source.infolist():
+                    target.writestr(info, container if info.filename == 'META-INF/container.xml'
+                                    else source.read(info))
+
+            self.assertRaises(epubmangler.EPubError, epubmangler.read_metadata, FILENAME)
+            self.assertRaises(epubmangler.EPubError, epubmangler.EPub, FILENAME, lazy=True)
+            self.assertRaises(epubmangler.EPubError, epubmangler.EPub, FILENAME)
         # TODO: Need some bad epub files to test here
 
 
@@ -1,35 +1,116 @@
 """A simple web application using fastapi and epubmangler."""
 
+import asyncio
 import enum
+import hashlib
+import heapq
+import inspect
+import itertools
+import multiprocessing
 import os
+import pickle
 import re
-import shutil
+import secrets
 import sys
 import time
 import uuid
 
 import xml.etree.ElementTree as ET
 
-from multiprocessing import Process
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
-from typing import Optional, Self, Sequence, TextIO
+from typing import (Any, AsyncIterator, BinaryIO, Callable, Dict, Iterator, List, Optional, Self,
+                    Sequence, TextIO, Tuple)
+from urllib.parse import quote
 
-from fastapi import FastAPI, File, UploadFile, Request
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import (FileResponse, HTMLResponse, JSONResponse, Response,
+                               StreamingResponse)
 from fastapi.staticfiles import StaticFiles
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.types import Receive, Scope, Send
 
 import uvicorn
 
-from epubmangler import EPub, EPubError, json_to_dict, strip_namespace
+from epubmangler import (AsyncEPub, AsyncRunner, EPubError, LOCAL_HEADER_SIGNATURE,
+                         RunnerFull, element_to_dict,
+                         image_type, json_to_dict, strip_namespace)
 
+from metrics import Counter, Gauge, Histogram, Registry
+from workers import cover_bytes, limit_memory, make_thumbnail, open_book, save_book, timed
 
-ROOT = Path("/home/david/Projects/epubmangler/web")
-UPLOAD = ROOT / "upload"
+
+ROOT = Path(__file__).resolve().parent
+UPLOAD = Path(os.environ.get("EPUBMANGLER_UPLOAD_DIR", ROOT / "upload"))
 IMAGES = UPLOAD / "image"
 STATIC = ROOT / "static"
 INDEX = STATIC / "main.html"
 TEMPLATE = open(STATIC / "template.html", mode="r", encoding="utf-8").read()
 
+# Writing files blocks, so it is done in threads, a few at a time
+RUNNER = AsyncRunner(concurrency=4)
+
+# Parsing and saving books, and reading covers, is done in worker processes (see WorkerPool)
+WORKERS = int(os.environ.get("EPUBMANGLER_WORKERS", os.cpu_count() or 1))
+QUEUE_SIZE = int(os.environ.get("EPUBMANGLER_QUEUE_SIZE", 4 * WORKERS))
+WORKER_MEMORY = int(os.environ.get("EPUBMANGLER_WORKER_MEMORY", 1024 * 1024 * 1024))
+WORKER_TASKS = int(os.environ.get("EPUBMANGLER_WORKER_TASKS", 100))
+RETRY_AFTER = int(os.environ.get("EPUBMANGLER_RETRY_AFTER", 5))
+
+# Covers are sent as thumbnails of these sizes, in pixels, and the edit page uses the last one.
+# A thumbnail never changes, so browsers may keep it for as long as they like.
+COVER_SIZES = (100, 200, 400)
+COVER_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Exported at /metrics. The gauges are added once the objects they read from exist.
+METRICS = Registry()
+REQUEST_SECONDS = METRICS.add(Histogram(
+    "epubmangler_request_duration_seconds",
+    "Time taken to start each response, by method, route and status code.",
+    ("method", "route", "status")))
+UPLOAD_BYTES = METRICS.add(Histogram(
+    "epubmangler_upload_size_bytes", "Size of uploaded files.",
+    buckets=[2 ** power for power in range(16, 29, 2)]))
+EPUB_ERRORS = METRICS.add(Counter(
+    "epubmangler_epub_errors_total", "Books that couldn't be opened or changed, by operation.",
+    ("operation",)))
+WORKER_SECONDS = METRICS.add(Histogram(
+    "epubmangler_worker_duration_seconds",
+    "Time spent in worker processes opening, saving and reading books, by function.",
+    ("function",)))
+STAGE_SECONDS = METRICS.add(Histogram(
+    "epubmangler_book_stage_duration_seconds",
+    "Time spent in each stage of work on books in worker processes, such as parse_opf, by "
+    "stage. Stages can contain others, see epubmangler.hooks.",
+    ("stage",)))
+WORKER_WAIT_SECONDS = METRICS.add(Histogram(
+    "epubmangler_worker_wait_seconds",
+    "Time spent waiting for a worker process and sending work to and from it, by function.",
+    ("function",)))
+REJECTED = METRICS.add(Counter(
+    "epubmangler_rejected_requests_total",
+    "Requests turned away with 503 because the worker processes were busy."))
+
+# Uploads are written to disk in chunks of this size, and larger uploads are refused
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get("EPUBMANGLER_MAX_UPLOAD_SIZE", 200 * 1024 * 1024))
+
+# The multipart form around an upload may add this many bytes to the size of the file
+MAX_FORM_OVERHEAD = 64 * 1024
+
+# Downloads are sent in chunks of this size, so the server never copies the whole book at once
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Opened books are kept between /edit and /download, within these limits
+MAX_SESSIONS = int(os.environ.get("EPUBMANGLER_MAX_SESSIONS", 64))
+MAX_SESSION_BYTES = int(os.environ.get("EPUBMANGLER_MAX_SESSION_BYTES", 512 * 1024 * 1024))
+SESSION_LIFE_TIME = int(os.environ.get("EPUBMANGLER_SESSION_LIFE_TIME", 600))
+
 
 class ERROR_LEVEL(enum.IntEnum):
     INFO = 0
@@ -42,12 +123,508 @@ class TemplateResponse(HTMLResponse):
 
     `html` is string representing the body of the final webpage's HTML."""
 
-    def __init__(self, html: str) -> Self:
-        HTMLResponse.__init__(self, TEMPLATE.replace("{{body}}", html))
+    def __init__(self, html: str, status_code: int = 200) -> Self:
+        HTMLResponse.__init__(self, TEMPLATE.replace("{{body}}", html), status_code)
+
+
+class BookResponse(StreamingResponse):
+    """Streams `data`, the book in `session` saved as a new epub file, in chunks of
+    `DOWNLOAD_CHUNK_SIZE`. Once the response is over, the session is released. This is done in
+    a `finally` rather than a background task, which isn't run if the client goes away part way
+    through."""
+
+    def __init__(self, data: bytes, session: "Session") -> Self:
+        StreamingResponse.__init__(
+            self, self.chunks(data), media_type="application/epub+zip",
+            headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(session.name)}",
+                     "Content-Length": str(len(data))})
+        self.session = session
+
+    @staticmethod
+    async def chunks(data: bytes) -> AsyncIterator[bytes]:
+        """Yields `data` in chunks of `DOWNLOAD_CHUNK_SIZE`."""
+
+        for start in range(0, len(data), DOWNLOAD_CHUNK_SIZE):
+            yield data[start:start + DOWNLOAD_CHUNK_SIZE]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await StreamingResponse.__call__(self, scope, receive, send)
+        finally:
+            await SESSIONS.release(self.session)
+
+
+class UploadError(Exception):
+    """Raised by `save_upload` and `open_upload` when an upload is refused. `status_code` is the
+    HTTP status code to respond with."""
+
+    def __init__(self, message: str, status_code: int) -> Self:
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+class UploadParser:
+    """Picks the file in the `file` field out of a multipart form while the form is received,
+    so it never has to be spooled to disk first. Each chunk of the request body is passed to
+    `feed`, which returns the part of the file that it contained. Other fields are ignored.
+
+    `name` is the name the file was uploaded with, once its headers have been received."""
+
+    def __init__(self, boundary: bytes) -> Self:
+        self.name: Optional[str] = None
+        self._headers: Dict[bytes, bytes] = {}
+        self._field = b""
+        self._value = b""
+        self._in_file = False
+        self._data = bytearray()
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._part_begin,
+            "on_header_field": self._header_field,
+            "on_header_value": self._header_value,
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+        })
+
+    def _part_begin(self) -> None:
+        self._headers = {}
+        self._in_file = False
+
+    def _header_field(self, data: bytes, start: int, end: int) -> None:
+        self._field += data[start:end]
+
+    def _header_value(self, data: bytes, start: int, end: int) -> None:
+        self._value += data[start:end]
+
+    def _header_end(self) -> None:
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b""
+
+    def _headers_finished(self) -> None:
+        _disposition, options = parse_options_header(self._headers.get(b"content-disposition"))
+
+        # Only the first file is kept, if there is more than one
+        if self.name is None and options.get(b"name") == b"file" and b"filename" in options:
+            self.name = options[b"filename"].decode("utf-8", "replace")
+            self._in_file = True
+
+    def _part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._data += data[start:end]
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Parses `chunk`, the next part of the form, and returns the file data in it."""
+
+        self._parser.write(chunk)
+        data = bytes(self._data)
+        self._data.clear()
+        return data
+
+    def finish(self) -> None:
+        """Called once the whole form has been fed."""
+
+        self._parser.finalize()
+
+
+class WorkerPool:
+    """Runs the work on books that uses the CPU, parsing and saving them and reading covers, in
+    worker processes, so it doesn't hold up the event loop.
+
+    At most `workers` functions run at once, and at most `queue_size` more wait their turn.
+    Past that, `run` raises `RunnerFull`, which is answered with 503 and a Retry-After header,
+    so under a burst of uploads requests are turned away rather than taking longer and longer.
+
+    Each worker's memory is limited to `memory_limit` bytes, and workers are replaced after
+    `tasks_per_child` tasks, so memory they have built up is given back."""
+
+    def __init__(self, workers: int = WORKERS, queue_size: int = QUEUE_SIZE,
+                 memory_limit: int = WORKER_MEMORY, tasks_per_child: int = WORKER_TASKS) -> Self:
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.tasks_per_child = tasks_per_child
+        self.runner = AsyncRunner(self._executor(), workers, queue_size)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        # Workers are started with spawn, as replacing them isn't supported with fork
+        return ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"),
+                                   limit_memory, (self.memory_limit,),
+                                   max_tasks_per_child=self.tasks_per_child)
+
+    async def run(self, function: Callable, *args: Any) -> Any:
+        """Returns the result of `function(*args)`, called in a worker process. The function
+        and its arguments are pickled, so it must be defined in a module of its own (see
+        workers.py). If a worker dies, the pool is replaced, so later calls still work."""
+
+        executor = self.runner.executor
+        start = time.perf_counter()
+
+        try:
+            result, seconds, stages = await self.runner.run(timed, function, *args)
+        except BrokenProcessPool:
+            if self.runner.executor is executor:
+                self.runner.executor = self._executor()
+                executor.shutdown(wait=False)
+
+            raise
+
+        WORKER_SECONDS.observe(seconds, function=function.__name__)
+
+        for stage, stage_seconds in stages:
+            STAGE_SECONDS.observe(stage_seconds, stage=stage)
+
+        WORKER_WAIT_SECONDS.observe(time.perf_counter() - start - seconds,
+                                    function=function.__name__)
+        return result
+
+    def shutdown(self) -> None:
+        """Stops the worker processes."""
+
+        self.runner.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Janitor:
+    """Calls cleanup functions, such as closing a session or removing a file, once their time
+    has come. They are kept in a heap ordered by deadline, and the janitor sleeps until the next
+    one is due, so the cost of cleaning up depends on how many things expire and not on how many
+    files are on disk.
+
+    It runs as a task in the server's event loop (see `start`)."""
+
+    def __init__(self) -> Self:
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()  # Keeps callbacks with the same deadline in order
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    async def run(self) -> None:
+        """Calls each callback when it is due, forever."""
+
+        self._wakeup = asyncio.Event()
+
+        while True:
+            now = time.monotonic()
+
+            while self._heap and self._heap[0][0] <= now:
+                _deadline, _count, callback = heapq.heappop(self._heap)
+
+                try:
+                    result = callback()
+
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as error:  # One failure shouldn't stop the janitor
+                    log(f"Cleanup failed: {error}", level=ERROR_LEVEL.WARNING)
+
+            self._wakeup.clear()
+
+            try:
+                timeout = self._heap[0][0] - now if self._heap else None
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def schedule(self, deadline: float, callback: Callable[[], Any]) -> None:
+        """Calls `callback` at `deadline`, a time from `time.monotonic`. If it returns an
+        awaitable, that is awaited too."""
+
+        heapq.heappush(self._heap, (deadline, next(self._counter), callback))
+
+        # Wake the janitor up if it is sleeping past the new deadline
+        if self._wakeup and self._heap[0][2] is callback:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """Starts the janitor in the running event loop."""
+
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        """Stops the janitor. Callbacks that aren't due yet are not called."""
+
+        if self._task:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+
+class Upload:
+    """An uploaded epub file, stored under the SHA-256 hash of its contents, and what has been
+    read from it so far. Identical uploads share one of these, so each book is only stored,
+    parsed and has its cover copied once, however many times it is uploaded.
+
+    `book` is the parsed, unchanged book, pickled so that each session can have a copy of its
+    own without parsing the file again. `cover` is the copy of its cover image in `IMAGES`, once
+    it has been written, or None, and `thumbnails` are the thumbnails of it that have been made,
+    by size. `users` counts the sessions using the upload."""
+
+    def __init__(self, store: "UploadStore", digest: str, path: Path, book: bytes) -> Self:
+        self.store = store
+        self.digest = digest
+        self.path = path
+        self.book = book
+        self.size = path.stat().st_size
+        self.cover: Optional[Path] = None
+        self.cover_checked = False
+        self.thumbnails: Dict[int, Optional[Path]] = {}
+        self.lock = asyncio.Lock()  # Held while the cover and thumbnails are written
+        self.users = 0
+        self.released = 0.0
+
+    def open(self) -> AsyncEPub:
+        """Returns a new copy of the book, for a session to change as it likes."""
+
+        return AsyncEPub(pickle.loads(self.book), RUNNER)
+
+    def release(self) -> None:
+        """Called when a session using the upload is closed."""
+
+        self.store.release(self)
+
+
+class UploadStore:
+    """Keeps uploads under the SHA-256 hash of their contents, counting the sessions that use
+    each one. An upload that no session has used for `life_time` seconds is removed, along with
+    its cover, by the janitor. Until then an identical upload uses it again.
+
+    Only one request at a time opens an upload with a given hash (see `opening`), so identical
+    uploads that arrive together are parsed once and never write over each other's file."""
+
+    def __init__(self, janitor: "Janitor", life_time: int = SESSION_LIFE_TIME) -> Self:
+        self.janitor = janitor
+        self.life_time = life_time
+        self._uploads: Dict[str, Upload] = {}
+        self._opening: Dict[str, asyncio.Event] = {}  # Set once the upload has been opened
+
+    def __len__(self) -> int:
+        return len(self._uploads)
+
+    def acquire(self, digest: str) -> Optional[Upload]:
+        """Returns the upload with the hash `digest`, and counts one more user, or returns None
+        if there isn't one."""
+
+        upload = self._uploads.get(digest)
+
+        if upload:
+            upload.users += 1
+
+        return upload
+
+    def add(self, digest: str, path: Path, book: bytes) -> Upload:
+        """Stores the upload at `path`, which should be `path_for(digest)`, and its parsed book,
+        and returns it with one user counted. If an identical upload was stored meanwhile, that
+        is returned instead."""
+
+        upload = self._uploads.setdefault(digest, Upload(self, digest, path, book))
+        upload.users += 1
+        return upload
+
+    @contextmanager
+    def opening(self, digest: str) -> Iterator[None]:
+        """Marks the upload with the hash `digest` as being opened, until the block ends. Other
+        requests with the same upload `wait` for it meanwhile. Use this straight after `wait`,
+        without awaiting anything in between."""
+
+        event = self._opening[digest] = asyncio.Event()
+
+        try:
+            yield
+        finally:
+            del self._opening[digest]
+            event.set()
+
+    async def wait(self, digest: str) -> None:
+        """Waits until no other request is opening the upload with the hash `digest`. If that
+        succeeded, the upload can then be acquired, otherwise it is up to the caller to try."""
+
+        while event := self._opening.get(digest):
+            await event.wait()
+
+    def close(self) -> None:
+        """Removes every upload that isn't in use."""
+
+        for digest, upload in list(self._uploads.items()):
+            if not upload.users:
+                self._remove(digest)
+
+    def collect(self, digest: str) -> None:
+        """Called by the janitor when the upload with the hash `digest` may have expired."""
+
+        upload = self._uploads.get(digest)
+
+        if upload and not upload.users and upload.released + self.life_time <= time.monotonic():
+            self._remove(digest)
+
+    def _remove(self, digest: str) -> None:
+
+        upload = self._uploads.pop(digest)
+        upload.path.unlink(missing_ok=True)
+
+        for image in (upload.cover, *upload.thumbnails.values()):
+            if image:
+                image.unlink(missing_ok=True)
+
+    @staticmethod
+    def path_for(digest: str) -> Path:
+        """Returns where the upload with the hash `digest` is stored."""
+
+        return UPLOAD / f"{digest}.epub"
+
+    def release(self, upload: Upload) -> None:
+        """Counts one less user of `upload`. Once it has none, it expires in `life_time`."""
+
+        upload.users -= 1
+
+        if not upload.users:
+            upload.released = time.monotonic()
+            self.janitor.schedule(upload.released + self.life_time,
+                                  partial(self.collect, upload.digest))
+
+
+class Session:
+    """A copy of an uploaded book, kept between requests so that it can be changed and
+    downloaded.
+
+    `name` is the name the book was uploaded with. `size` is the number of bytes the session
+    counts against the store's budget. A session in use (see `SessionStore.acquire`) is only
+    closed once it has been released."""
+
+    def __init__(self, token: str, epub: AsyncEPub, name: str, upload: Upload, size: int,
+                 expires: float) -> Self:
+        self.token = token
+        self.epub = epub
+        self.name = name
+        self.upload = upload
+        self.size = size
+        self.expires = expires
+        self.users = 0
+        self.evicted = False
+
+    async def close(self) -> None:
+        """Removes the book's temporary directory and releases its upload."""
+
+        await self.epub.close()
+        self.upload.release()
+
+
+class SessionStore:
+    """Keeps opened books in memory between requests, under an opaque token.
+
+    Sessions are evicted when they haven't been used for `life_time` seconds, or, least
+    recently used first, to keep the store within `max_sessions` books and `max_bytes` bytes.
+    Evicted sessions are closed straight away rather than left for the garbage collector, so
+    their temporary directories and uploads are removed at a predictable time. If `janitor` is
+    given, each session is also evicted when it expires, even if no other request comes in.
+
+    The store is only used from the event loop, so it needs no locks."""
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS, max_bytes: int = MAX_SESSION_BYTES,
+                 life_time: int = SESSION_LIFE_TIME, janitor: Janitor = None) -> Self:
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.life_time = life_time
+        self.janitor = janitor
+        self.size = 0
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    async def acquire(self, token: str) -> Optional[Session]:
+        """Returns the session for `token`, or None if there isn't one or it has expired. The
+        session is marked as used, and won't be closed until it is passed to `release`."""
+
+        await self.expire()
+        session = self._sessions.get(token)
+
+        if session:
+            session.expires = time.monotonic() + self.life_time
+            session.users += 1
+            self._sessions.move_to_end(token)
+
+        return session
+
+    async def add(self, epub: AsyncEPub, name: str, upload: Upload, size: int) -> str:
+        """Stores `epub`, a copy of `upload`, in a new session and returns its token. The upload
+        is released when the session is closed."""
+
+        token = secrets.token_urlsafe(32)
+        session = Session(token, epub, name, upload, size, time.monotonic() + self.life_time)
+        self._sessions[token] = session
+        self.size += size
+
+        if self.janitor is not None:
+            self.janitor.schedule(session.expires, partial(self.collect, token))
+
+        # The new session is the most recently used, so it is only evicted if it's over budget
+        while self._sessions and (len(self._sessions) > self.max_sessions or
+                                  self.size > self.max_bytes):
+            await self.evict(next(iter(self._sessions)))
+
+        await self.expire()
+        return token
+
+    async def collect(self, token: str) -> None:
+        """Called by the janitor when the session for `token` is due to expire. If it has been
+        used since it was scheduled, it is scheduled again for its new expiry time."""
+
+        session = self._sessions.get(token)
+
+        if session and session.expires > time.monotonic():
+            self.janitor.schedule(session.expires, partial(self.collect, token))
+        elif session:
+            await self.evict(token)
+
+    async def close(self) -> None:
+        """Evicts every session."""
+
+        for token in list(self._sessions):
+            await self.evict(token)
+
+    async def evict(self, token: str) -> None:
+        """Removes the session for `token` and closes it, unless it is in use."""
+
+        session = self._sessions.pop(token, None)
+
+        if session:
+            self.size -= session.size
+            session.evicted = True
+
+            if not session.users:
+                await session.close()
+
+    async def expire(self) -> None:
+        """Evicts the sessions that haven't been used within their life time. They are kept in
+        order of use, so only the expired ones are looked at."""
+
+        now = time.monotonic()
+
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+
+            if session.expires > now:
+                break
+
+            await self.evict(session.token)
+
+    async def release(self, session: Session) -> None:
+        """Marks `session` as no longer used, and closes it if it was evicted meanwhile."""
+
+        session.users -= 1
+
+        if session.evicted and not session.users:
+            await session.close()
 
 
 def log(
-    message: str, level: int = 0,
+    message: str, level: ERROR_LEVEL = ERROR_LEVEL.INFO,
     pid: int = 0, file: Optional[TextIO] = sys.stdout) -> None:
     """Prints a message that looks kind of like the ones made by uvicorn.
 
@@ -71,35 +648,251 @@ def log(
     print(final_message, file=file)
 
 
-def tidy(
-    directories: Sequence[os.PathLike[str]],
-    life_time: int = 600,
-    sleep_length: int = 300,
-) -> None:
-    """Remove all files in a group of directories on a regular basis.
+def remove_stale_files(directories: Sequence[os.PathLike[str]], life_time: int) -> int:
+    """Removes the files in `directories` that were last modified more than `life_time` seconds
+    ago, and returns how many were removed. Files written while the server is running are
+    removed by the janitor, so this is only needed once at startup, for files left behind by a
+    server that didn't shut down cleanly."""
+
+    removed = 0
+    oldest = time.time() - life_time
+
+    for directory in directories:
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.stat().st_mtime < oldest:
+                os.remove(entry.path)
+                removed += 1
+
+    return removed
+
+
+def write_chunk(file: BinaryIO, digest: Any, chunk: bytes) -> None:
+    """Writes `chunk` to `file` and adds it to `digest`. Both release the GIL for large chunks,
+    so this is run in a thread."""
+
+    digest.update(chunk)
+    file.write(chunk)
+
+
+async def save_upload(request: Request, path: Path,
+                      max_size: int = MAX_UPLOAD_SIZE) -> Tuple[str, str]:
+    """Streams the file in the `file` field of the multipart form posted in `request` to `path`
+    while it is received, in chunks of `UPLOAD_CHUNK_SIZE`, so it is never held in memory all at
+    once or written to disk twice. Returns the name it was uploaded with and its SHA-256 hash.
+
+    Raises `UploadError`, and removes what was written, if there is no file, if the file is
+    larger than `max_size`, or if it doesn't start like a zip file. A request that is too large
+    is refused by its Content-Length, or as soon as too much of it has been received, without
+    reading the rest. Whether the file really is an epub file is left for `EPub` to check when
+    it opens it, as epub files that don't start with `mimetype` can still be read."""
+
+    content_type, options = parse_options_header(request.headers.get("content-type"))
+    length = request.headers.get("content-length", "")
+    too_large = UploadError(f"The upload is larger than the limit of "
+                            f"{max_size // (1024 * 1024)} MB", 413)
 
-    `directories` the list of directories to monitor
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise UploadError("Expected a file uploaded as multipart/form-data", 400)
 
-    `life_time` the number of seconds to retain files
+    if length.isdigit() and int(length) > max_size + MAX_FORM_OVERHEAD:
+        raise too_large
 
-    `sleep_length` the number of seconds to sleep after each iteration"""
+    parser = UploadParser(options[b"boundary"])
+    digest = hashlib.sha256()
+    start = bytearray()  # The first bytes of the file, to check it is a zip file
+    pending = bytearray()
+    received = size = 0
 
-    while True:
-        for dir in directories:
-            for file in os.listdir(dir):
-                path = Path(dir, file)
-                if path.is_dir():
-                    continue
-                if path.stat().st_mtime > life_time:
-                    os.remove(path)
+    try:
+        with open(path, "wb") as output:
+            async for chunk in request.stream():
+                received += len(chunk)
+                data = parser.feed(chunk)
+                size += len(data)
+
+                if size > max_size or received > max_size + MAX_FORM_OVERHEAD:
+                    raise too_large
+
+                if len(start) < len(LOCAL_HEADER_SIGNATURE):
+                    start += data[:len(LOCAL_HEADER_SIGNATURE) - len(start)]
+
+                    if not LOCAL_HEADER_SIGNATURE.startswith(start):
+                        raise UploadError(f"Not a valid epub file: {parser.name}", 415)
+
+                pending += data
+
+                if len(pending) >= UPLOAD_CHUNK_SIZE:
+                    await RUNNER.run(write_chunk, output, digest, bytes(pending))
+                    pending.clear()
+
+            parser.finish()
+
+            if parser.name is None:
+                raise UploadError("No file was uploaded", 400)
+
+            if len(start) < len(LOCAL_HEADER_SIGNATURE):
+                raise UploadError(f"Not a valid epub file: {parser.name}", 415)
+
+            await RUNNER.run(write_chunk, output, digest, bytes(pending))
+    except MultipartParseError as error:
+        path.unlink(missing_ok=True)
+        raise UploadError("The upload is not a valid multipart form", 400) from error
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+    return parser.name, digest.hexdigest()
+
+
+async def open_upload(request: Request) -> Session:
+    """Saves the file uploaded in `request`, opens it and stores it in a new session, which is
+    returned. Raises `UploadError` if the upload is refused or isn't an epub file that can be
+    opened.
+
+    The upload is hashed as it is saved. If an identical file has been uploaded recently, the
+    new copy is thrown away and the book that was parsed then is used again."""
+
+    filename = UPLOAD / f"{uuid.uuid4()}.part"
+
+    # A session for anything larger would be evicted from the store as soon as it was added
+    name, digest = await save_upload(request, filename, min(MAX_UPLOAD_SIZE, SESSIONS.max_bytes))
+    name = Path(name).name
+    UPLOAD_BYTES.observe(filename.stat().st_size)
+
+    try:
+        await UPLOADS.wait(digest)  # For an identical upload that arrived first
+    except BaseException:
+        filename.unlink(missing_ok=True)
+        raise
+
+    stored = UPLOADS.acquire(digest)
+
+    if stored:
+        filename.unlink()
+        log(f"Uploaded {name} again (sha256: {digest})")
+    else:
+        log(f"Uploaded {name} (sha256: {digest})")
+        path = UPLOADS.path_for(digest)
+
+        # Nothing else uses `path` until the upload has been added, so it is only ours to remove
+        with UPLOADS.opening(digest):
+            try:
+                os.replace(filename, path)
+                book = await POOL.run(open_book, path)
+            except EPubError as error:
+                EPUB_ERRORS.inc(operation="open")
+                path.unlink(missing_ok=True)
+                raise UploadError(f"Not a valid epub file: {name}", 422) from error
+            except BaseException:
+                filename.unlink(missing_ok=True)
+                path.unlink(missing_ok=True)
+                raise
+
+            stored = UPLOADS.add(digest, path, pickle.dumps(book))
+
+    # The upload is roughly what the book can grow to in memory and in its temporary directory
+    token = await SESSIONS.add(stored.open(), name, stored, stored.size)
+
+    return await SESSIONS.acquire(token)
+
+
+def apply_patch(epub: AsyncEPub, operations: Any) -> None:
+    """Applies a list of changes to the metadata of `epub`, all together or not at all. Each
+    change is a record like those returned by `metadata_records`, along with an `op`, which is
+    one of `add`, `set` or `remove`, the `EPub` method that is used to make it:
+
+    `[{"op": "set", "tag": "title", "text": "Frankenstein"},
+    {"op": "add", "tag": "subject", "text": "Horror"},
+    {"op": "remove", "tag": "date", "attrib": {"event": "modification"}}]`
+
+    Books usually have several subjects, so they are added and removed by their text with
+    `add_subject` and `remove_subject` instead.
+
+    Raises `ValueError` if `operations` is malformed and `EPubError` if a change can't be made."""
+
+    if not isinstance(operations, list):
+        raise ValueError("Expected a list of changes")
+
+    with epub.batch():
+        for operation in operations:
+            if not isinstance(operation, dict) or not isinstance(operation.get("tag"), str):
+                raise ValueError(f"Not a valid change: {operation}")
+
+            tag, text = operation["tag"], operation.get("text", "")
+            attrib = operation.get("attrib") or None
+
+            # Anything but strings would only fail once the book is saved, after the change
+            if not isinstance(text, str) or not isinstance(attrib or {}, dict) or not all(
+                    isinstance(item, str) for pair in (attrib or {}).items() for item in pair):
+                raise ValueError(f"Not a valid change: {operation}")
+
+            match operation.get("op"), tag:
+                case "add", "subject":
+                    epub.add_subject(text)
+                case "add", _:
+                    epub.add(tag, text, attrib)
+                case "set", _:
+                    epub.set(tag, text, attrib)
+                case "remove", "subject" if text:
+                    epub.remove_subject(text)
+                case "remove", _:
+                    epub.remove(tag, attrib)
+                case _:
+                    raise ValueError(f"Not a valid change: {operation}")
+
+
+def metadata_records(epub: AsyncEPub) -> List[Dict[str, Any]]:
+    """Returns the metadata of `epub` in document order, as a list of records like
+    `{"tag": "creator", "text": "Mary Shelley", "attrib": {"role": "aut"}}`. See
+    `element_to_dict`."""
+
+    return [element_to_dict(element) for element in epub.metadata]
+
+
+async def send_book(session: Session) -> BookResponse:
+    """Saves the book in `session` as a new epub file, in memory, in a worker process, and
+    returns a response that streams it. Nothing is written to disk. Once it has been sent, the
+    session is released (see `BookResponse`)."""
 
-        time.sleep(sleep_length)
+    return BookResponse(await POOL.run(save_book, session.epub.book), session)
 
 
 # Set up our FastAPI application
+IMAGES.mkdir(parents=True, exist_ok=True)
 app = FastAPI()
+POOL = WorkerPool()
+JANITOR = Janitor()
+SESSIONS = SessionStore(janitor=JANITOR)
+UPLOADS = UploadStore(JANITOR)
+METRICS.add(Gauge("epubmangler_worker_queue_depth",
+                  "Functions waiting for a worker process.", lambda: POOL.runner.waiting()))
+METRICS.add(Gauge("epubmangler_janitor_backlog",
+                  "Cleanups waiting for their time to come.", lambda: len(JANITOR)))
+METRICS.add(Gauge("epubmangler_sessions", "Open sessions.", lambda: len(SESSIONS)))
+METRICS.add(Gauge("epubmangler_session_bytes",
+                  "Bytes counted against the session store's budget.", lambda: SESSIONS.size))
+METRICS.add(Gauge("epubmangler_uploads", "Uploads kept by their hash.", lambda: len(UPLOADS)))
+
+
+@app.middleware("http")
+async def record_time(request: Request, call_next: Callable) -> Response:
+    """Records how long each request takes to answer, by the route it matched rather than its
+    path, so there is one series for /covers/{digest} rather than one for every cover."""
+
+    start = time.perf_counter()
+    status = 500
+
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                route=route.path if route else "other", status=status)
+
+
 app.mount("/static", StaticFiles(directory=STATIC), name="static")
-app.mount("/upload", StaticFiles(directory=UPLOAD), name="upload")
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -108,46 +901,55 @@ async def main() -> HTMLResponse:
     return HTMLResponse(open(INDEX, mode="r", encoding="utf-8").read())
 
 
-@app.post("/edit", response_class=TemplateResponse)
-async def edit(file: UploadFile = File(...)) -> TemplateResponse:
-    """The edit page of our application."""
+@app.get("/metrics")
+async def metrics() -> Response:
+    """Returns the server's metrics in the Prometheus text format."""
 
-    filename = Path(UPLOAD / file.filename)
+    return Response(METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-    with open(filename, "wb") as temp:
-        temp.write(await file.read())
+
+@app.post("/edit", response_class=TemplateResponse)
+async def edit(request: Request) -> TemplateResponse:
+    """The edit page of our application."""
 
     try:
-        epub = EPub(filename)
-    except EPubError:
-        os.remove(filename)
+        session = await open_upload(request)
+    except UploadError as error:
+        if error.status_code != 422:
+            return TemplateResponse(f"<p>{error}</p>", status_code=error.status_code)
+
         return TemplateResponse(
-            f"""<p>Not a valid epub file: {filename.name}\n\n
+            f"""<p>{error}\n\n
             Create an issue at 
             <a href="https://github.com/davekeogh/epubmangler/issues">
             https://github.com/davekeogh/epubmangler/issues</a> 
-            if your epub is not supported properly. Sorry!</p>"""
+            if your epub is not supported properly. Sorry!</p>""", status_code=error.status_code
         )
 
-    html = f"""<form action="/download" method="post">
-        <input type="hidden" name="filename" value="{filename}" />"""
+    try:
+        return await edit_page(session)
+    finally:
+        await SESSIONS.release(session)
 
-    cover_path = Path(epub.get_cover())
 
-    if cover_path:
-        temp_cover = Path()
+async def edit_page(session: Session) -> TemplateResponse:
+    """Returns the form used to edit the book in `session`. The book is kept open for /download,
+    which only needs the session's token to find it again."""
 
-        if cover_path.is_file():
-            temp_cover = UPLOAD / "image" / f"{uuid.uuid4()}{cover_path.suffix}"
-            shutil.copy(cover_path, temp_cover)
+    epub, name, upload = session.epub, session.name, session.upload
 
-        if temp_cover.is_file():
-            html += '<input type="file" id="cover-upload" name="cover-upload" accept="image/*" />'
+    html = f"""<form action="/download" method="post">
+        <input type="hidden" name="token" value="{session.token}" />"""
 
-            alt_text = f'Cover page of {epub["title"].text} by {epub["creator"].text}'
-            html += f'<img src="{temp_cover.relative_to(ROOT)}" id="cover" alt="{alt_text}" />'
+    # The cover isn't read here. The browser fetches a thumbnail of it, which it can cache.
+    if epub.get_cover_name():
+        html += '<input type="file" id="cover-upload" name="cover-upload" accept="image/*" />'
 
-    html += f"""<h1>Editing: {filename.name}</h1>
+        alt_text = f'Cover page of {epub["title"].text} by {epub["creator"].text}'
+        html += f"""<img src="/covers/{upload.digest}?size={COVER_SIZES[-1]}" id="cover"
+            alt="{alt_text}" />"""
+
+    html += f"""<h1>Editing: {name}</h1>
             <p>Pro tip: Don't touch the <em>Attrib</em> column, unless you know what you are doing.</p>
             <table><tr><th>Tag</th><th>Text</th><th>Attrib</th><th class="blank"></th></tr>"""
 
@@ -179,28 +981,49 @@ async def edit(file: UploadFile = File(...)) -> TemplateResponse:
     return TemplateResponse(html)
 
 
-@app.post("/download", response_class=FileResponse)
-async def download(request: Request) -> FileResponse:  # TemplateResponse
-    """Download the edited epub."""
+@app.post("/download", response_class=StreamingResponse)
+async def download(request: Request) -> StreamingResponse:  # TemplateResponse
+    """Download the edited epub. The book opened by /edit is used again, rather than being
+    read from the upload again, and it is saved in a worker process (see `send_book`)."""
 
     form = await request.form()
-    filename = Path(form["filename"])
+    session = await SESSIONS.acquire(form.get("token", ""))
 
-    if not filename or filename.parent != UPLOAD:
-        return TemplateResponse(f"bad request: {form}")
+    if not session:
+        return TemplateResponse(
+            "<p>This book is no longer open. Please upload it again.</p>", status_code=410
+        )
+
+    if session.users > 1:
+        await SESSIONS.release(session)
+        return TemplateResponse("<p>This book is already being downloaded.</p>", status_code=409)
+
+    try:
+        return await edited_book(form, session)
+    except BaseException:
+        await SESSIONS.release(session)
+        raise
 
-    epub = EPub(form["filename"])
+
+async def edited_book(form: Any, session: Session) -> StreamingResponse:
+    """Applies the changes in `form` to the book in `session` and returns a response that
+    sends it. The session is released once the response has been sent."""
+
+    epub = session.epub
     items = []
     new_items = []
 
     for field in form.keys():
-        if field.endswith("-text") or field.endswith("-attrib") or field == "filename":
+        if field.endswith("-text") or field.endswith("-attrib") or field == "token":
             continue
         if field == "cover-upload":
-            try:
-                epub.set_cover(form["cover-upload"])
-            except EPubError:
-                epub.add_cover(form["cover-upload"])
+            # Uploaded images are read from the upload itself rather than saved first
+            cover = getattr(form["cover-upload"], "file", form["cover-upload"])
+
+            if epub.has_element("cover"):
+                await RUNNER.run(epub.set_cover, cover)
+            else:
+                await RUNNER.run(epub.add_cover, cover)
         if re.match("(new[0-9]*)-(.+)", field):
             new_items.append(ET.Element(field))
 
@@ -216,15 +1039,261 @@ async def download(request: Request) -> FileResponse:  # TemplateResponse
     items += new_items
 
     epub.update(items)
-    epub.save(filename, overwrite=True)
 
     # return TemplateResponse(f'Downloading: {Path(epub.file).name}...')
-    return FileResponse(filename, filename=filename.name)
+    return await send_book(session)
+
+
+async def upload_cover(upload: Upload) -> Optional[Path]:
+    """Returns the copy of the upload's cover image in `IMAGES`, writing it the first time, or
+    None if it doesn't have a cover. Call this with `upload.lock` held."""
+
+    if not upload.cover_checked:
+        book = pickle.loads(upload.book)
+        cover = await POOL.run(cover_bytes, book)
+
+        if cover:
+            # Written straight from the archive, without extracting it first
+            upload.cover = IMAGES / f"{upload.digest}{Path(book.get_cover_name()).suffix}"
+            await RUNNER.run(upload.cover.write_bytes, cover)
+
+        upload.cover_checked = True
+
+    return upload.cover
+
+
+async def cover_thumbnail(upload: Upload, size: int) -> Optional[Path]:
+    """Returns a thumbnail of the upload's cover that is `size` pixels at most, or None if it
+    doesn't have a cover. Each size is only made once, in a worker process."""
+
+    async with upload.lock:
+        if size not in upload.thumbnails:
+            cover = await upload_cover(upload)
+
+            if cover:
+                target = IMAGES / f"{upload.digest}-{size}{cover.suffix}"
+                upload.thumbnails[size] = await POOL.run(make_thumbnail, cover, target, size)
+            else:
+                upload.thumbnails[size] = None
+
+    return upload.thumbnails[size]
+
+
+@app.get("/covers/{digest}")
+async def cover_image(digest: str, size: int = COVER_SIZES[-1],
+                if_none_match: Optional[str] = Header(None)) -> Response:
+    """Returns a thumbnail of the cover of the upload with the SHA-256 hash `digest`. `size` is
+    rounded up to the next of `COVER_SIZES`.
+
+    The thumbnail is named by the hash of the upload it came from and its size, or is the cover
+    itself if it is small enough or Pillow isn't installed, so it never changes. Its ETag is its
+    name. Browsers are told to cache it, and when they ask whether it has changed the answer is
+    no, without sending it again."""
+
+    size = next((cover_size for cover_size in COVER_SIZES if cover_size >= size),
+                COVER_SIZES[-1])
+    upload = UPLOADS.acquire(digest)
+
+    if not upload:
+        return Response(status_code=404)
+
+    try:
+        thumbnail = await cover_thumbnail(upload, size)
+    finally:
+        upload.release()
+
+    if not thumbnail:
+        return Response(status_code=404)
+
+    etag = f'"{thumbnail.stem}"'
+    headers = {"ETag": etag, "Cache-Control": COVER_CACHE_CONTROL}
+
+    if if_none_match and (if_none_match.strip() == "*" or etag in [
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(thumbnail, headers=headers)
+
+
+# A JSON interface to the same sessions, for programs rather than browsers. A book is uploaded
+# once, and then read, changed and downloaded as often as needed until its session expires.
+
+
+def json_error(message: str, status_code: int) -> JSONResponse:
+    """Returns an error response for the JSON interface."""
+
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+@app.post("/api/books", status_code=201)
+async def api_upload(request: Request) -> JSONResponse:
+    """Opens an uploaded book and returns its token, name and metadata."""
+
+    try:
+        session = await open_upload(request)
+    except UploadError as error:
+        return json_error(str(error), error.status_code)
+
+    try:
+        return JSONResponse({"token": session.token, "name": session.name,
+                             "metadata": metadata_records(session.epub)}, status_code=201)
+    finally:
+        await SESSIONS.release(session)
+
+
+@app.get("/api/books/{token}")
+async def api_download(token: str) -> Response:
+    """Streams the book, with any changes that have been made, as an epub file."""
+
+    session = await SESSIONS.acquire(token)
+
+    if not session:
+        return json_error("No such book, or it has expired", 404)
+
+    if session.users > 1:
+        await SESSIONS.release(session)
+        return json_error("The book is in use", 409)
+
+    try:
+        return await send_book(session)
+    except BaseException:
+        await SESSIONS.release(session)
+        raise
+
+
+@app.delete("/api/books/{token}", status_code=204)
+async def api_close(token: str) -> Response:
+    """Closes the book and removes its files, without waiting for its session to expire."""
+
+    await SESSIONS.evict(token)
+    return Response(status_code=204)
+
+
+@app.get("/api/books/{token}/cover")
+async def api_cover(token: str) -> Response:
+    """Returns the book's cover image."""
+
+    session = await SESSIONS.acquire(token)
+
+    if not session:
+        return json_error("No such book, or it has expired", 404)
+
+    try:
+        cover = await POOL.run(cover_bytes, session.epub.book)
+
+        if not cover:
+            return json_error("The book has no cover", 404)
+
+        return Response(cover, media_type=image_type(cover) or "application/octet-stream")
+    finally:
+        await SESSIONS.release(session)
+
+
+@app.get("/api/books/{token}/metadata")
+async def api_metadata(token: str) -> Response:
+    """Returns the book's metadata as a list of records. See `metadata_records`."""
+
+    session = await SESSIONS.acquire(token)
+
+    if not session:
+        return json_error("No such book, or it has expired", 404)
+
+    try:
+        return JSONResponse(metadata_records(session.epub))
+    finally:
+        await SESSIONS.release(session)
+
+
+@app.patch("/api/books/{token}/metadata")
+async def api_patch_metadata(token: str, request: Request) -> Response:
+    """Changes the book's metadata, and returns it. See `apply_patch` for the format. If any
+    change can't be made, none of them are."""
+
+    session = await SESSIONS.acquire(token)
+
+    if not session:
+        return json_error("No such book, or it has expired", 404)
+
+    try:
+        if session.users > 1:
+            return json_error("The book is in use", 409)
+
+        apply_patch(session.epub, await request.json())
+        return JSONResponse(metadata_records(session.epub))
+    except ValueError as error:  # Includes JSON decoding errors
+        return json_error(str(error), 400)
+    except EPubError as error:
+        EPUB_ERRORS.inc(operation="patch")
+        return json_error(" ".join(str(error).split()), 422)
+    finally:
+        await SESSIONS.release(session)
+
+
+@app.exception_handler(BrokenProcessPool)
+@app.exception_handler(RunnerFull)
+async def busy(request: Request, _error: Exception) -> Response:
+    """Turns requests away while the worker processes are busy, or have just been replaced."""
+
+    message = "The server is busy. Please try again in a few seconds."
+    REJECTED.inc()
+
+    if request.url.path.startswith("/covers/"):  # Fetched by <img>, so a page would be wasted
+        response = Response(status_code=503)
+    elif request.url.path.startswith("/api/"):
+        response = json_error(message, 503)
+    else:
+        response = TemplateResponse(f"<p>{message}</p>", status_code=503)
+
+    response.headers["Retry-After"] = str(RETRY_AFTER)
+    return response
+
+
+@app.exception_handler(EPubError)
+async def epub_error(request: Request, error: EPubError) -> Response:
+    """A change to a book couldn't be made, for instance because a new cover isn't an image."""
+
+    EPUB_ERRORS.inc(operation="request")
+    message = " ".join(str(error).split())
+
+    if request.url.path.startswith("/api/"):
+        return json_error(message, 422)
+
+    return TemplateResponse(f"<p>{message}</p>", status_code=422)
+
+
+@app.exception_handler(MemoryError)
+async def too_large(request: Request, _error: MemoryError) -> Response:
+    """A book used more memory than a worker process is allowed."""
+
+    message = "This book is too large to be edited here."
+
+    if request.url.path.startswith("/api/"):
+        return json_error(message, 413)
+
+    return TemplateResponse(f"<p>{message}</p>", status_code=413)
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    """Removes files left behind by an earlier server and starts the janitor."""
+
+    removed = await RUNNER.run(remove_stale_files, (UPLOAD, IMAGES), SESSION_LIFE_TIME)
+
+    if removed:
+        log(f"Removed {removed} stale files", ERROR_LEVEL.INFO)
+
+    JANITOR.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    """Stops the janitor and closes every open book, so no temporary files are left behind."""
+
+    await JANITOR.stop()
+    await SESSIONS.close()
+    UPLOADS.close()
+    POOL.shutdown()
 
 
-if __name__ == "__main__":
-    p = Process(target=tidy, args=((UPLOAD, IMAGES), 600, 300))
-    p.start()
-    log("Started tidy process", level=ERROR_LEVEL.INFO, pid=p.pid)
+if __name__ == "__main__":  # Worker processes import this file again, see workers.py
     uvicorn.run(app, host="127.0.0.1", port=8000)
-    log("Finished tidy process", level=ERROR_LEVEL.INFO, pid=p.pid)
@@ -0,0 +1,158 @@
+"""Counters, gauges and histograms for the web application, written in the Prometheus text
+format (https://prometheus.io/docs/instrumenting/exposition_formats/) without depending on
+prometheus_client.
+
+Metrics are only changed from the event loop, so they need no locks."""
+
+import bisect
+import math
+
+from typing import Callable, Dict, List, Optional, Self, Sequence, Tuple
+
+# In seconds, from a few milliseconds to the time a large book can take to save
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value: float) -> str:
+    """Returns a sample value as Prometheus expects it."""
+
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Returns the label set `{name="value",...}` of a sample, or nothing if there are none."""
+
+    if not names:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    """A named metric, with a value for each combination of the values of `labels`."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Self:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> List[str]:
+        """Returns the lines of the text format for this metric."""
+
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}",
+                *self.samples()]
+
+    def samples(self) -> List[str]:
+        """Returns a line for each value of the metric."""
+
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A count that only goes up, such as the number of failed requests."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Self:
+        Metric.__init__(self, name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {} if labels else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Adds `amount` to the count."""
+
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, such as the length of a queue. It is read from `function`
+    each time the metrics are rendered, so it is never out of date."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]) -> Self:
+        Metric.__init__(self, name, documentation)
+        self.function = function
+
+    def samples(self) -> List[str]:
+
+        return [f"{self.name} {format_value(self.function())}"]
+
+
+class Histogram(Metric):
+    """Counts observed values, such as how long requests take, in `buckets`, along with their
+    sum and count."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> Self:
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # Bucket counts, sum, count
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Records `value`."""
+
+        values = self._values.setdefault(self._key(labels), [0] * (len(self.buckets) + 2))
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def samples(self) -> List[str]:
+
+        lines = []
+        names = self.labels + ("le",)
+
+        for key, values in self._values.items():
+            total = 0
+
+            for bucket, count in zip(self.buckets, values):
+                total += count
+                labels = format_labels(names, key + (format_value(bucket),))
+                lines.append(f"{self.name}_bucket{labels} {total}")
+
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+
+        return lines
+
+
+class Registry:
+    """The metrics that are exported together."""
+
+    def __init__(self) -> Self:
+        self.metrics: List[Metric] = []
+
+    def add(self, metric: Metric) -> Metric:
+        """Adds `metric` to the registry and returns it."""
+
+        self.metrics.append(metric)
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        """Returns the metric called `name`, or None if there isn't one."""
+
+        return next((metric for metric in self.metrics if metric.name == name), None)
+
+    def render(self) -> str:
+        """Returns every metric in the text format."""
+
+        return "".join(f"{line}\n" for metric in self.metrics for line in metric.render())
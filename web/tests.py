@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Test the web application's upload, session and JSON interfaces, in the way a browser or a
+program would use them. Uploads are written to a temporary directory, which is removed at the
+end."""
+
+import asyncio
+import hashlib
+import importlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from pathlib import Path
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from starlette.requests import ClientDisconnect
+
+BOOK = Path(__file__).resolve().parent.parent / 'example' / 'Frankenstein.epub'
+DIGEST = hashlib.sha256(BOOK.read_bytes()).hexdigest()
+
+# main.py reads its settings from the environment when it is imported, see setUpModule
+main = None
+UPLOAD_DIR = None
+
+# pylint: skip-file
+
+
+def setUpModule():
+    global main, UPLOAD_DIR
+
+    # Imported here rather than at the top, so worker processes, which import this module
+    # again, don't make upload directories of their own
+    UPLOAD_DIR = tempfile.mkdtemp(prefix='epubmangler-web-')
+    os.environ['EPUBMANGLER_UPLOAD_DIR'] = UPLOAD_DIR
+    os.environ['EPUBMANGLER_WORKERS'] = '1'
+    main = importlib.import_module('main')
+
+
+def tearDownModule():
+    shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
+
+
+class WebTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Left behind by a server that didn't shut down cleanly, for the startup hook to remove
+        for stale in (main.UPLOAD / 'stale.part', main.IMAGES / 'stale.png'):
+            stale.write_bytes(b'stale')
+            os.utime(stale, (0, 0))
+
+        cls.client = TestClient(main.app)
+        cls.client.__enter__()  # Runs the startup and shutdown hooks
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+
+    def upload(self, url='/api/books', data=None, name='Frankenstein.epub'):
+        data = BOOK.read_bytes() if data is None else data
+        return self.client.post(url, files={'file': (name, data, 'application/epub+zip')})
+
+    def form_request(self, data):
+        body = (b'--book\r\nContent-Disposition: form-data; name="file"; filename="book.epub"'
+                b'\r\n\r\n' + data + b'\r\n--book--\r\n')
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        headers = [(b'content-type', b'multipart/form-data; boundary=book')]
+        return main.Request({'type': 'http', 'method': 'POST', 'headers': headers}, receive)
+
+    def test_identical_uploads(self):
+        run = main.POOL.run
+        opened = []
+        fail_first = False
+
+        async def counted_run(function, *args):
+            if function is main.open_book:
+                opened.append(args)
+
+                if fail_first and len(opened) == 1:  # Give the second upload time to arrive
+                    await asyncio.sleep(0.2)
+                    raise main.RunnerFull
+
+            return await run(function, *args)
+
+        async def upload_twice(data):
+            return await asyncio.gather(main.open_upload(self.form_request(data)),
+                                        main.open_upload(self.form_request(data)),
+                                        return_exceptions=True)
+
+        async def release(sessions):
+            for session in sessions:
+                await main.SESSIONS.release(session)
+
+        # If the first upload fails, the second opens the book itself, otherwise it waits for it
+        for fail_first, sessions_expected, opened_expected in ((True, 1, 2), (False, 2, 1)):
+            buffer = io.BytesIO(BOOK.read_bytes())
+
+            with zipfile.ZipFile(buffer, 'a') as zip_file:  # A book that isn't stored yet
+                zip_file.comment = str(fail_first).encode()
+
+            digest = hashlib.sha256(buffer.getvalue()).hexdigest()
+            opened.clear()
+
+            with mock.patch.object(main.POOL, 'run', counted_run):
+                results = self.client.portal.call(upload_twice, buffer.getvalue())
+
+            sessions = [result for result in results if isinstance(result, main.Session)]
+            self.client.portal.call(release, sessions)
+            self.assertEqual(len(sessions), sessions_expected)
+            self.assertEqual(len(opened), opened_expected)
+
+            self.assertTrue(main.UPLOADS.path_for(digest).exists())
+            upload = main.UPLOADS.acquire(digest)
+            self.assertIsNotNone(upload)
+            upload.release()
+
+        self.assertEqual([path.name for path in Path(UPLOAD_DIR).glob('*.part')], [])
+
+    def test_startup(self):
+        self.assertFalse((main.UPLOAD / 'stale.part').exists())
+        self.assertFalse((main.IMAGES / 'stale.png').exists())
+
+    def test_edit(self):
+        response = self.upload('/edit')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Editing: Frankenstein.epub', response.text)
+        self.assertIn('/covers/', response.text)
+
+        response = self.upload('/edit', b'not a book', 'notabook.epub')
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual([path.name for path in Path(UPLOAD_DIR).glob('*.part')], [])
+
+    def test_download(self):
+        response = self.upload('/edit')
+        token = re.search('name="token" value="([^"]+)"', response.text).group(1)
+
+        response = self.client.post('/download', data={'token': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['content-type'], 'application/epub+zip')
+        self.assertEqual(int(response.headers['content-length']), len(response.content))
+        self.assertTrue(response.content.startswith(b'PK\x03\x04'))
+        self.assertEqual(list(Path(UPLOAD_DIR).glob('*-*-*.epub')), [])  # Never written to disk
+
+        response = self.client.post('/download', data={'token': 'nothing'})
+        self.assertEqual(response.status_code, 410)
+
+    def test_download_disconnect(self):
+        token = self.upload().json()['token']
+
+        async def disconnect():
+            session = await main.SESSIONS.acquire(token)
+            response = await main.send_book(session)
+
+            async def receive():
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.body':
+                    raise OSError('The client went away')
+
+            # From ASGI 2.4, servers raise OSError from send() once the client has gone
+            scope = {'type': 'http', 'method': 'GET', 'headers': [],
+                     'asgi': {'spec_version': '2.4'}}
+
+            with self.assertRaises((OSError, ClientDisconnect)):
+                await response(scope, receive, send)
+
+            return session
+
+        session = self.client.portal.call(disconnect)
+        self.assertEqual(session.users, 0)
+
+    def test_too_large(self):
+        max_bytes = main.SESSIONS.max_bytes
+        main.SESSIONS.max_bytes = 1000
+
+        try:
+            response = self.upload()
+        finally:
+            main.SESSIONS.max_bytes = max_bytes
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual([path.name for path in Path(UPLOAD_DIR).glob('*.part')], [])
+
+    def test_too_large_stream(self):
+        # Sent in chunks without a Content-Length, so the limit has to be checked while reading
+        boundary = b'limit'
+        chunks = [b'--limit\r\nContent-Disposition: form-data; name="file"; '
+                  b'filename="big.epub"\r\n\r\n']
+        chunks += [b'PK\x03\x04' + bytes(main.MAX_FORM_OVERHEAD)] * 100
+        chunks += [b'\r\n--limit--\r\n']
+        sent = []
+        path = main.UPLOAD / 'big.part'
+
+        async def receive():
+            sent.append(chunks[len(sent)])
+            return {'type': 'http.request', 'body': sent[-1], 'more_body': len(sent) < len(chunks)}
+
+        async def upload():
+            headers = [(b'content-type', b'multipart/form-data; boundary=' + boundary)]
+            request = main.Request({'type': 'http', 'method': 'POST', 'headers': headers},
+                                   receive)
+
+            with self.assertRaises(main.UploadError) as context:
+                await main.save_upload(request, path, 4 * main.MAX_FORM_OVERHEAD)
+
+            return context.exception
+
+        error = self.client.portal.call(upload)
+        self.assertEqual(error.status_code, 413)
+        self.assertLess(len(sent), 10)  # The rest was never read
+        self.assertFalse(path.exists())
+
+    def test_bad_form(self):
+        response = self.client.post('/api/books', data={'other': 'field'},
+                                    files={'cover': ('cover.png', b'PNG', 'image/png')})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/api/books', content=BOOK.read_bytes(),
+                                    headers={'Content-Type': 'application/epub+zip'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_covers(self):
+        self.upload()
+        response = self.client.get(f'/covers/{DIGEST}?size=150')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('image/'))
+
+        # Named by what is sent: a thumbnail, or the cover itself if Pillow isn't installed
+        upload = main.UPLOADS.acquire(DIGEST)
+        etag = f'"{upload.thumbnails[200].stem}"'
+        upload.release()
+        self.assertEqual(response.headers['etag'], etag)
+
+        if importlib.import_module('workers').Image is None:
+            self.assertEqual(etag, f'"{DIGEST}"')
+
+        response = self.client.get(f'/covers/{DIGEST}?size=150', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(f'/covers/{"0" * 64}', headers={'If-None-Match': '*'})
+        self.assertEqual(response.status_code, 404)
+
+        self.assertEqual(self.client.get(f'/upload/{DIGEST}.epub').status_code, 404)
+
+    def test_covers_busy(self):
+        self.upload()
+
+        with mock.patch.object(main, 'cover_thumbnail', side_effect=main.RunnerFull):
+            response = self.client.get(f'/covers/{DIGEST}')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response.headers['retry-after'], str(main.RETRY_AFTER))
+
+    def test_api(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 201)
+        token = response.json()['token']
+        self.assertIn('title', [record['tag'] for record in response.json()['metadata']])
+
+        response = self.client.patch(f'/api/books/{token}/metadata',
+                                     json=[{'op': 'set', 'tag': 'title', 'text': 'Something'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn({'tag': 'title', 'text': 'Something', 'attrib': {}}, response.json())
+
+        response = self.client.patch(f'/api/books/{token}/metadata', json={'op': 'set'})
+        self.assertEqual(response.status_code, 400)
+
+        for change in ({'op': 'add', 'tag': 'title', 'text': 'T', 'attrib': {'x': 1}},
+                       {'op': 'add', 'tag': 'title', 'text': 1}):
+            response = self.client.patch(f'/api/books/{token}/metadata', json=[change])
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(f'/api/books/{token}/cover')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('image/'))
+
+        response = self.client.get(f'/api/books/{token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['content-type'], 'application/epub+zip')
+        self.assertTrue(response.content.startswith(b'PK\x03\x04\x14\x00\x00\x00\x00\x00'))
+
+        self.assertEqual(self.client.delete(f'/api/books/{token}').status_code, 204)
+        self.assertEqual(self.client.get(f'/api/books/{token}/metadata').status_code, 404)
+
+    def test_metrics(self):
+        self.upload()
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('epubmangler_upload_size_bytes_count', response.text)
+        self.assertIn('epubmangler_worker_duration_seconds_count{function="open_book"}',
+                      response.text)
+        self.assertIn('route="/api/books",status="201"', response.text)
+
+        # Parsing is timed apart from opening the archive
+        for stage in ('zip_open', 'parse_opf'):
+            self.assertIn(f'epubmangler_book_stage_duration_seconds_count{{stage="{stage}"}}',
+                          response.text)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
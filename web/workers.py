@@ -0,0 +1,91 @@
+"""The work that the web application does in its worker processes: parsing, saving and reading
+covers from books, and making thumbnails of covers. It is kept apart from main.py, so that a
+worker can find these functions by importing this module and epubmangler alone.
+
+Workers are started with spawn, which also imports the server's `__main__` module again in
+each of them. Started with `uvicorn main:app`, that is uvicorn's. Started with `python main.py`,
+it is main.py itself, imported as `__mp_main__`: its module-level setup runs again in every
+worker, although no server is started there.
+
+Books are pickled to be sent to a worker and back again (see `EPub.__getstate__`)."""
+
+import time
+
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    from PIL import Image
+except ImportError:  # Covers are sent at full size without Pillow
+    Image = None
+
+from epubmangler import EPub, hooked
+
+
+def limit_memory(limit: int) -> None:
+    """Limits the address space of the worker process to `limit` bytes, where the platform
+    allows it, so one huge book raises MemoryError rather than using all of the server's
+    memory. This is the pool's initializer."""
+
+    if resource and limit:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def cover_bytes(book: EPub) -> Optional[bytes]:
+    """Returns the contents of the book's cover image, or None if it doesn't have one."""
+
+    cover = book.get_cover_bytes()
+    return bytes(cover) if cover else None
+
+
+def make_thumbnail(source: Path, target: Path, size: int) -> Path:
+    """Writes a copy of the image at `source` to `target`, scaled down to fit in a square of
+    `size` pixels, and returns `target`. Returns `source` instead if it already fits, or if
+    Pillow isn't installed."""
+
+    if Image is None:
+        return source
+
+    with Image.open(source) as image:
+        if max(image.size) <= size:
+            return source
+
+        image_format = image.format
+        image.thumbnail((size, size))
+        image.save(target, format=image_format)
+
+    return target
+
+
+def open_book(path: Path) -> EPub:
+    """Opens the epub file at `path`. Only the OPF file is read, so there is nothing in the
+    book's temporary directory that could be removed when the worker's copy is."""
+
+    return EPub(path, lazy=True)
+
+
+def save_book(book: EPub) -> bytes:
+    """Returns `book` saved as a new epub file. It is written in memory, as in the worker it can
+    only be sent back whole, and writing it to disk first would mean reading it back again."""
+
+    return book.to_bytes()
+
+
+def timed(function: Callable, *args: Any) -> Tuple[Any, float, List[Tuple[str, float]]]:
+    """Returns the result of `function(*args)` and how long it took in seconds, so the time
+    spent working can be told apart from the time spent waiting for a worker. Also returns the
+    name and duration of each stage of work on a book that it did, such as parsing the OPF file
+    (see `epubmangler.hooks`)."""
+
+    stages = []
+    start = time.perf_counter()
+
+    with hooked(lambda event: stages.append((event.name, event.duration))):
+        result = function(*args)
+
+    return result, time.perf_counter() - start, stages